@@ -0,0 +1,55 @@
+import sys
+import time
+import tatort_wiki_lib as TW
+import wiki_pages
+
+Date_Params = ('VG-DATUM', 'NF-DATUM', 'Premiere', 'Premiere_DE', 'Sender')
+
+class DateSeries(TW.SeriesConfig):
+	name = 'Tatort'
+
+class DateInfo(object):
+	def __init__(self, page_name):
+		self.page_name = page_name
+
+def read_dates(filename):
+	dates = []
+	for page in wiki_pages.read_snapshot(filename):
+		for name, params in page.raw_extracted_templates:
+			for param in Date_Params:
+				value = params.get(param)
+				if value is not None:
+					dates.append((page.title, param, value))
+	return dates
+
+def run(dates, repeat):
+	TW.Current_Result = TW.PageResult()
+	with TW.current_series(DateSeries()):
+		start = time.perf_counter()
+		for i in range(repeat):
+			for page_name, param, value in dates:
+				TW.parse_date(DateInfo(page_name), param, value)
+		elapsed = time.perf_counter() - start
+	TW.Current_Result = None
+	return elapsed
+
+def main(args):
+	if not 1 <= len(args) <= 2:
+		TW.err('Usage: python3 bench-dates.py snapshot.jsonl [repeat]')
+	repeat = int(args[1]) if len(args) > 1 else 10
+	dates = read_dates(args[0])
+
+	cached = TW.normalize_date
+	TW.normalize_date = cached.__wrapped__
+	uncached_time = run(dates, repeat)
+	TW.normalize_date = cached
+	cached.cache_clear()
+	cached_time = run(dates, repeat)
+
+	print(f'{len(dates):,} dates ({len(set(dates)):,} distinct) x {repeat}')
+	print(f'uncached: {uncached_time:.3f} s')
+	print(f'cached:   {cached_time:.3f} s ({uncached_time / cached_time:.1f}x)')
+	print(cached.cache_info())
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -0,0 +1,196 @@
+import contextlib
+import datetime
+import io
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tatort_wiki_lib as TW
+import wiki_pages
+
+Series_Script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tatort-wiki.py')
+First_Date = datetime.date(1970, 1, 1)
+Month_Names = ('Januar', 'Februar', 'März', 'April', 'Mai', 'Juni',
+	'Juli', 'August', 'September', 'Oktober', 'November', 'Dezember')
+
+def episode_name(ep):
+	return 'Fall {}'.format(ep)
+
+def episode_date(ep):
+	d = First_Date + datetime.timedelta(days=ep)
+	return '{}. {} {}'.format(d.day, Month_Names[d.month - 1], d.year)
+
+def neighbour(ep, n):
+	if 1 <= ep <= n:
+		return episode_name(ep), episode_date(ep)
+	return TW.EnDash, ''
+
+# Each kind of error makes the validator write at least one LOG line.
+Errors = {
+	'date':         lambda p: p.update(premiere='31. Februar 2000'),
+	'imdb':         lambda p: p.update(imdb_title='Falscher Titel'),
+	'fans':         lambda p: p.update(fans_url='falsche-url'),
+	'folgenleiste': lambda p: p.update(extra='| VG-ARTIKLE = X\n'),
+	'infobox':      lambda p: p.update(regie=''),
+	'neighbour':    lambda p: p.update(prev='Falscher Fall'),
+}
+
+def page_text(p):
+	return f"""{{{{Infobox Episode
+| Serie = Tatort (Fernsehreihe)
+| Serienlogo = Tatort Logo mini.svg
+| Reihe = ja
+| Originaltitel = {p['name']}
+| Produktionsland = Deutschland
+| Originalsprache = Deutsch
+| Länge = 89 Minuten
+| Episode = {p['ep']}
+| Episodenliste = Liste der Tatort-Folgen
+| Premiere = {p['premiere']}
+| Sender = [[Das Erste]]
+| Regie = {p['regie']}
+| Drehbuch = Autorin
+| Kamera = Kameramann
+| Schnitt = Cutterin
+| Besetzung = Kommissarin
+}}}}
+'''{p['name']}''' ist ein Fernsehfilm aus der Kriminalreihe ''[[Tatort (Fernsehreihe)|Tatort]]''.
+
+{{{{Folgenleiste Tatort-Folgen
+| VG = {p['prev']}
+| VG-DATUM = {p['prev_date']}
+| NF = {p['next']}
+| NF-DATUM = {p['next_date']}
+{p['extra']}}}}}
+
+== Weblinks ==
+* {{{{IMDb|tt{p['ep']:07}|{p['imdb_title']}}}}}
+* {{{{Tatort-Fans|Nr={p['ep']}|Url={p['fans_url']}}}}}
+* {{{{Tatort-Folge|Url={p['folge_url']}}}}}
+
+[[Kategorie:Filmtitel {p['year']}]]
+[[Kategorie:Tatort (Fernsehreihe)]]
+"""
+
+def generate_pages(n, error_rate, seed, title2url):
+	rng = random.Random(seed)
+	errors = list(Errors.values())
+	for ep in range(1, n + 1):
+		name = episode_name(ep)
+		url = title2url(name)
+		prev, prev_date = neighbour(ep - 1, n)
+		next_name, next_date = neighbour(ep + 1, n)
+		p = {
+			'ep': ep,
+			'name': name,
+			'premiere': episode_date(ep),
+			'year': (First_Date + datetime.timedelta(days=ep)).year,
+			'regie': 'Regisseur',
+			'prev': prev,
+			'prev_date': prev_date,
+			'next': next_name,
+			'next_date': next_date,
+			'extra': '',
+			'imdb_title': name,
+			'fans_url': url,
+			'folge_url': url + '-100',
+		}
+		if rng.random() < error_rate:
+			rng.choice(errors)(p)
+		yield wiki_pages.WikiPage('Tatort: ' + name, 0, ep, page_text(p),
+			['Kategorie:Filmtitel {}'.format(p['year']), 'Kategorie:Tatort (Fernsehreihe)'])
+
+def run(script, n, error_rate, seed, jobs):
+	TW.get_pages = lambda navbar, **params: generate_pages(n, error_rate, seed, script.title2url)
+
+	output = io.StringIO()
+	with tempfile.TemporaryDirectory() as tmpdir:
+		cwd = os.getcwd()
+		os.chdir(tmpdir)
+		try:
+			for filename in ('tatort-fans-url-map.txt', 'tatort-folge-url-map.txt'):
+				open(filename, 'w').close()
+			start = time.perf_counter()
+			with contextlib.redirect_stdout(output):
+				script.main(['jobs={}'.format(jobs)])
+			elapsed = time.perf_counter() - start
+		finally:
+			os.chdir(cwd)
+
+	lines = output.getvalue().splitlines()
+	num_log = sum(1 for line in lines if line.startswith('LOG|'))
+	return elapsed, num_log, len(lines) - num_log
+
+def parse_rate(value):
+	value = float(value)
+	if not 0 <= value <= 1:
+		raise ValueError('must be between 0 and 1')
+	return value
+
+def parse_pages(value):
+	value = int(value)
+	if not 1 <= value <= 1000000:
+		raise ValueError('must be between 1 and 1000000')
+	return value
+
+Valid_Params = {
+	'baseline': str,
+	'errors': parse_rate,
+	'jobs': TW.parse_jobs,
+	'pages': parse_pages,
+	'save': str,
+	'seed': int,
+	'tolerance': parse_rate,
+}
+
+def main(args):
+	params = TW.parse_args(args, Valid_Params)
+	n = params.get('pages', 1000)
+	error_rate = params.get('errors', 0.05)
+	seed = params.get('seed', 1)
+	jobs = params.get('jobs', 1)
+
+	script = TW.load_module('tatort_wiki', Series_Script)
+
+	start = time.perf_counter()
+	for page in generate_pages(n, error_rate, seed, script.title2url):
+		pass
+	generate_time = time.perf_counter() - start
+
+	elapsed, num_log, num_episodes = run(script, n, error_rate, seed, jobs)
+	elapsed = max(elapsed - generate_time, 1e-9)
+	result = {
+		'pages': n,
+		'errors': error_rate,
+		'jobs': jobs,
+		'pages_per_sec': round(n / elapsed, 1),
+		'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+	}
+	print('{:,} pages | {:,} episodes | {:,} LOG lines | {:.2f} s | {:,.1f} pages/sec | {:,.1f} MB peak RSS'.format(
+		n, num_episodes, num_log, elapsed, result['pages_per_sec'], result['peak_rss_mb']))
+
+	status = 0
+	baseline = params.get('baseline')
+	if baseline and os.path.exists(baseline):
+		with open(baseline) as f:
+			base = json.load(f)
+		ratio = result['pages_per_sec'] / base['pages_per_sec']
+		print('Baseline: {:,.1f} pages/sec | {:,.1f} MB peak RSS | {:.2f}x'.format(
+			base['pages_per_sec'], base['peak_rss_mb'], ratio))
+		if ratio < 1 - params.get('tolerance', 0.1):
+			print('Slower than the baseline!', file=sys.stderr)
+			status = 1
+
+	save = params.get('save')
+	if save:
+		with open(save, 'w') as f:
+			json.dump(result, f, indent='\t')
+			print(file=f)
+
+	sys.exit(status)
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
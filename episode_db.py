@@ -0,0 +1,189 @@
+import os
+import sqlite3
+from episode_urls import read_url_map, title2url
+
+# An optional SQLite store for the episode lists that tatort.py and the wiki
+# validators otherwise exchange as pipe-delimited text files. The validators
+# write the wiki episodes, tatort.py writes the parsed daserste.de and
+# tatort-fans.de indexes, and the hand-edited title and URL maps are copied
+# in whenever their file changes. Each list is replaced in one transaction.
+
+Schema = '''
+CREATE TABLE IF NOT EXISTS wiki_episodes (
+	series TEXT NOT NULL,
+	ep INTEGER NOT NULL,
+	date TEXT NOT NULL,
+	title TEXT NOT NULL,
+	slug TEXT NOT NULL,
+	url TEXT NOT NULL,
+	PRIMARY KEY (series, ep)
+);
+CREATE INDEX IF NOT EXISTS wiki_episodes_date ON wiki_episodes (series, date);
+CREATE INDEX IF NOT EXISTS wiki_episodes_slug ON wiki_episodes (slug);
+CREATE INDEX IF NOT EXISTS wiki_episodes_url ON wiki_episodes (url);
+
+CREATE TABLE IF NOT EXISTS html_episodes (
+	series TEXT NOT NULL,
+	ep INTEGER NOT NULL,
+	date TEXT NOT NULL,
+	title TEXT NOT NULL,
+	slug TEXT NOT NULL,
+	urls TEXT NOT NULL,
+	PRIMARY KEY (series, ep)
+);
+CREATE INDEX IF NOT EXISTS html_episodes_date ON html_episodes (series, date);
+CREATE INDEX IF NOT EXISTS html_episodes_slug ON html_episodes (slug);
+
+CREATE TABLE IF NOT EXISTS html_urls (
+	series TEXT NOT NULL,
+	ep INTEGER NOT NULL,
+	url TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS html_urls_ep ON html_urls (series, ep);
+CREATE INDEX IF NOT EXISTS html_urls_url ON html_urls (url);
+
+CREATE TABLE IF NOT EXISTS fans_episodes (
+	ep INTEGER NOT NULL,
+	url TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS fans_episodes_ep ON fans_episodes (ep);
+CREATE INDEX IF NOT EXISTS fans_episodes_url ON fans_episodes (url);
+
+CREATE TABLE IF NOT EXISTS url_maps (
+	map TEXT NOT NULL,
+	ep INTEGER NOT NULL,
+	url TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS url_maps_ep ON url_maps (map, ep);
+CREATE INDEX IF NOT EXISTS url_maps_url ON url_maps (url);
+
+CREATE TABLE IF NOT EXISTS title_maps (
+	map TEXT NOT NULL,
+	wiki_title TEXT NOT NULL,
+	title TEXT NOT NULL,
+	PRIMARY KEY (map, wiki_title)
+);
+
+CREATE TABLE IF NOT EXISTS sources (
+	name TEXT PRIMARY KEY,
+	mtime_ns INTEGER NOT NULL,
+	size INTEGER NOT NULL
+);
+'''
+
+def file_stat(filename):
+	try:
+		stat = os.stat(filename)
+	except FileNotFoundError:
+		return 0, -1
+	return stat.st_mtime_ns, stat.st_size
+
+def read_title_map(filename):
+	with open(filename) as f:
+		for line in f:
+			yield line[:-1], f.readline()[:-1]
+
+class EpisodeDB(object):
+	def __init__(self, filename):
+		self.conn = sqlite3.connect(filename)
+		self.conn.execute('PRAGMA journal_mode=WAL')
+		self.conn.executescript(Schema)
+
+	def close(self):
+		self.conn.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+		return False
+
+	def changed(self, filename):
+		row = self.conn.execute('SELECT mtime_ns, size FROM sources WHERE name = ?', (filename,)).fetchone()
+		return row != file_stat(filename)
+
+	def set_source(self, filename):
+		self.conn.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?)', (filename, *file_stat(filename)))
+
+	def write_wiki_episodes(self, series, rows):
+		# rows are the fields of the lines in <series>-wiki-episodes.txt.
+		# Like the readers of that file, a later line for the same episode wins.
+		with self.conn:
+			self.conn.execute('DELETE FROM wiki_episodes WHERE series = ?', (series,))
+			self.conn.executemany('INSERT OR REPLACE INTO wiki_episodes VALUES (?, ?, ?, ?, ?, ?)',
+				[(series, int(ep), date, title, title2url(title), url[0] if url else '')
+					for ep, date, title, *url in rows])
+
+	def write_html_episodes(self, series, episodes, source=None):
+		with self.conn:
+			self.conn.execute('DELETE FROM html_episodes WHERE series = ?', (series,))
+			self.conn.execute('DELETE FROM html_urls WHERE series = ?', (series,))
+			self.conn.executemany('INSERT INTO html_episodes VALUES (?, ?, ?, ?, ?, ?)',
+				[(series, ep, date, title, title2url(title), urls) for ep, date, title, urls in episodes])
+			self.conn.executemany('INSERT INTO html_urls VALUES (?, ?, ?)',
+				[(series, ep, url) for ep, date, title, urls in episodes for url in urls.split(',') if url])
+			if source:
+				self.set_source(source)
+
+	def write_fans_episodes(self, episodes):
+		with self.conn:
+			self.conn.execute('DELETE FROM fans_episodes')
+			self.conn.executemany('INSERT INTO fans_episodes VALUES (?, ?)', episodes)
+
+	def sync_url_map(self, filename):
+		if not self.changed(filename):
+			return
+		with self.conn:
+			self.conn.execute('DELETE FROM url_maps WHERE map = ?', (filename,))
+			self.conn.executemany('INSERT INTO url_maps VALUES (?, ?, ?)',
+				[(filename, ep, url) for ep, url in read_url_map(filename)])
+			self.set_source(filename)
+
+	def sync_title_map(self, filename):
+		if not self.changed(filename):
+			return
+		with self.conn:
+			self.conn.execute('DELETE FROM title_maps WHERE map = ?', (filename,))
+			self.conn.executemany('INSERT OR REPLACE INTO title_maps VALUES (?, ?, ?)',
+				[(filename, wiki_title, title) for wiki_title, title in read_title_map(filename)])
+			self.set_source(filename)
+
+	def url_map(self, filename):
+		self.sync_url_map(filename)
+		return self.conn.execute('SELECT ep, url FROM url_maps WHERE map = ? ORDER BY rowid', (filename,))
+
+	def count(self, table, series=None):
+		if series is None:
+			return self.conn.execute('SELECT COUNT(*) FROM ' + table).fetchone()[0]
+		return self.conn.execute('SELECT COUNT(*) FROM ' + table + ' WHERE series = ?', (series,)).fetchone()[0]
+
+	def diff_rows(self, series, title_map):
+		# Each episode of the daserste.de index with its Wikipedia date, title
+		# (after the title map) and URL, or None for all three if the episode
+		# isn't on Wikipedia.
+		self.sync_title_map(title_map)
+		return self.conn.execute('''
+			SELECT h.ep, h.date, h.title, h.urls,
+				w.date, COALESCE(t.title, REPLACE(w.title, '\u2019', ?)), w.url
+			FROM html_episodes h
+			LEFT JOIN wiki_episodes w ON w.series = h.series AND w.ep = h.ep
+			LEFT JOIN title_maps t ON t.map = ? AND t.wiki_title = w.title
+			WHERE h.series = ?
+			ORDER BY h.ep''', ("'", title_map, series))
+
+	def urlmap_rows(self, series):
+		return self.conn.execute('''
+			SELECT h.ep, h.title, h.urls, w.title
+			FROM html_episodes h
+			JOIN wiki_episodes w ON w.series = h.series AND w.ep = h.ep
+			WHERE h.series = ?
+			ORDER BY h.ep''', (series,))
+
+	def fans_urlmap_rows(self, series):
+		return self.conn.execute('''
+			SELECT f.ep, f.url
+			FROM fans_episodes f
+			JOIN wiki_episodes w ON w.series = ? AND w.ep = f.ep
+			WHERE f.url != w.slug
+			ORDER BY f.ep, f.url''', (series,))
@@ -0,0 +1,33 @@
+import re
+
+# The episode URL helpers shared by tatort.py, tatort-wiki.py and episode_db.py
+
+Replace_With_Dash = re.compile('[^0-9a-z]+')
+Translation_Table = str.maketrans({
+	'ä': 'ae',
+	'ö': 'oe',
+	'ü': 'ue',
+	'ß': 'ss',
+	'â': 'a',
+	'à': 'a',
+	'é': 'e',
+	'ô': 'o',
+	'\u2019': None, # apostrophe (right single quotation mark)
+})
+
+def title2url(title):
+	url = title.lower().translate(Translation_Table)
+	url = Replace_With_Dash.sub('-', url)
+
+	if url[0] == '-':
+		url = url[1:]
+	if url[-1] == '-':
+		url = url[:-1]
+
+	return url
+
+def read_url_map(filename):
+	with open(filename) as f:
+		for line in f:
+			ep, url = line[:-1].split('|', maxsplit=1)
+			yield int(ep), url
@@ -1,11 +1,10 @@
 import re
+import sys
 import tatort_wiki_lib as TW
 
 log = TW.log
 
-TW.Series = 'Polizeiruf 110'
-TW.Series_Prefix = 'Polizeiruf 110: '
-TW.Alternate_Titles = {
+Alternate_Titles = {
 	'Polizeiruf 110: In Erinnerung an …': '"In Erinnerung an …"',
 }
 
@@ -29,18 +28,12 @@ class TatortInfo(object):
 			return ep
 		return None
 
-TW.Infobox_Series_Params.extend((
-	('Serie',         True,  'Polizeiruf 110'),
-	('Serienlogo',    False, ''),
-	('Episodenliste', True,  'Liste der Polizeiruf-110-Folgen'),
-))
-
 URL_Prefix = 'www.daserste.de/unterhaltung/krimi/polizeiruf-110/sendung/'
 URL_Suffix_Pattern = re.compile('^(?:[0-9]{4}/)?([0-9a-z]+(?:-[0-9a-z]+)*-?[0-9]{3})\\.html$')
 
 def get_urls(info, page):
 	urls = []
-	for url in page.extlinks():
+	for url in page.extlinks:
 		if url.startswith('https://'):
 			url = url[8:]
 		elif url.startswith('http://'):
@@ -58,35 +51,30 @@ def get_urls(info, page):
 		urls.append(m.group(1))
 	info.url = ','.join(urls)
 
-def main():
-	info_list = TW.process_pages(TatortInfo, get_urls)
-
-	next_ep = 1
-	prev = None
+class PolizeirufSeries(TW.SeriesConfig):
+	name = 'Polizeiruf 110'
+	info_class = TatortInfo
+	alternate_titles = Alternate_Titles
+	infobox_params = TW.SeriesConfig.infobox_params + (
+		('Serie',         True,  'Polizeiruf 110'),
+		('Serienlogo',    False, ''),
+		('Episodenliste', True,  'Liste der Polizeiruf-110-Folgen'),
+	)
 
-	for info in info_list:
-		ep = info.sortkey
-		if ep != next_ep:
-			log(info, 'Unexpected episode number|{}|{}', ep, next_ep)
-		elif prev:
-			TW.check_attrs(info, 'prev', prev)
-			TW.check_attrs(prev, 'next', info)
-		else:
-			TW.check_attr(info, 'prev_episode', '')
-			TW.check_attr(info, 'prev_ep_date', '')
+	def check_page(self, info, page):
+		get_urls(info, page)
 
+	def write_episodes(self, info):
 		if info.double_episode:
-			print(ep, info.infobox_date, info.episode_name + ' (1)', info.url, sep='|')
-			print(ep+1, info.part2_date, info.episode_name + ' (2)', info.url, sep='|')
-			next_ep = ep + 2
+			TW.write_episode(info.sortkey, info.infobox_date, info.episode_name + ' (1)', info.url)
+			TW.write_episode(info.sortkey + 1, info.part2_date, info.episode_name + ' (2)', info.url)
 		else:
-			print(info.episode_number, info.infobox_date, info.episode_name, info.url, sep='|')
-			next_ep = ep + 1
-		prev = info
+			TW.write_episode(info.episode_number, info.infobox_date, info.episode_name, info.url)
+
+Series = PolizeirufSeries()
 
-	if prev:
-		TW.check_attr(prev, 'next_episode', '')
-		TW.check_attr(prev, 'next_ep_date', '')
+def main(args):
+	TW.run_series([Series], TW.parse_args(args))
 
 if __name__ == '__main__':
-	main()
+	main(sys.argv[1:])
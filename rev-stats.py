@@ -1,6 +1,16 @@
+import array
+import bz2
+import concurrent.futures
+import gzip
+import heapq
+import itertools
+import json
+import os
 import pywikibot
 import re
 import sys
+import wiki_pages
+import xml.etree.ElementTree as ET
 
 def log(message, *args, **kwargs):
 	print(message.format(*args, **kwargs), file=sys.stderr)
@@ -9,95 +19,123 @@ def err(*args, **kwargs):
 	log(*args, **kwargs)
 	sys.exit()
 
-def date2str(d):
-	return '{}-{:02}-{:02} {:02}:{:02}:{:02}'.format(d.year, d.month, d.day, d.hour, d.minute, d.second)
-
-class User(object):
-	name2user = {}
-	sortkey = {
-		'articles': lambda u: (u.num_articles, u.num_authored, u.num_contribs, u.name),
-		'authored': lambda u: (u.num_authored, u.num_contribs, u.num_articles, u.name),
-		'contribs': lambda u: (u.num_contribs, u.num_authored, u.num_articles, u.name),
-	}
+# Dates are kept as int64 numbers of the form YYYYMMDDhhmmss, which
+# compare like the timestamps they were made from.
+Date_Digits = str.maketrans('', '', '-:TZ')
+No_Oldest = 99991231235959
+No_Newest = 0
 
-	def __init__(self, name, anon):
-		self.name = name
-		self.anon = anon
-		self.num_articles = 0
-		self.num_authored = 0
-		self.num_contribs = 0
+def parse_timestamp(timestamp):
+	return int(timestamp.translate(Date_Digits))
 
-	def check_oldest_newest(self, date, oldest_attr, newest_attr):
-		oldest = getattr(self, oldest_attr, None)
-		if oldest is None or date < oldest:
-			setattr(self, oldest_attr, date)
+def date2str(d):
+	d = str(d)
+	return f'{d[0:4]}-{d[4:6]}-{d[6:8]} {d[8:10]}:{d[10:12]}:{d[12:14]}'
 
-		newest = getattr(self, newest_attr, None)
-		if newest is None or newest < date:
-			setattr(self, newest_attr, date)
+def date2year(d):
+	return d // 10000000000
 
-	def inc_articles(self, date):
-		self.num_articles += 1
-		self.check_oldest_newest(date, 'date_oldest_articles', 'date_newest_articles')
+ARTICLES, AUTHORED, CONTRIBS = range(3)
+Attrs = ('articles', 'authored', 'contribs')
 
-	def inc_authored(self, date):
-		self.num_authored += 1
-		self.check_oldest_newest(date, 'date_oldest_authored', 'date_newest_authored')
+class UserTable(object):
+	# One row per user: names are interned to row ids, and the counters and
+	# oldest/newest dates for articles, authored and contribs are int64 columns.
 
-	def inc_contribs(self, date):
-		self.num_contribs += 1
-		self.check_oldest_newest(date, 'date_oldest_contribs', 'date_newest_contribs')
+	def __init__(self):
+		self.names = []
+		self.name2id = {}
+		self.anon = bytearray()
+		self.counts = [array.array('q') for attr in Attrs]
+		self.oldest = [array.array('q') for attr in Attrs]
+		self.newest = [array.array('q') for attr in Attrs]
+
+	def __len__(self):
+		return len(self.names)
+
+	def add(self, name, anon):
+		uid = len(self.names)
+		self.names.append(name)
+		self.name2id[name] = uid
+		self.anon.append(anon)
+		for counts, oldest, newest in zip(self.counts, self.oldest, self.newest):
+			counts.append(0)
+			oldest.append(No_Oldest)
+			newest.append(No_Newest)
+		return uid
 
-	@classmethod
 	def get(self, name, anon):
-		user = self.name2user.get(name)
-		if not user:
-			self.name2user[name] = user = self(name, anon)
-		elif user.anon != anon:
+		uid = self.name2id.get(name)
+		if uid is None:
+			return self.add(name, anon)
+		if self.anon[uid] != anon:
 			log('User "{}" was previously {}anonymous', name, 'not ' if anon else '')
-		return user
+		return uid
+
+	def inc(self, uid, attr, date):
+		self.counts[attr][uid] += 1
+		oldest = self.oldest[attr]
+		if date < oldest[uid]:
+			oldest[uid] = date
+		newest = self.newest[attr]
+		if newest[uid] < date:
+			newest[uid] = date
+
+	def dump(self):
+		return {name: [self.anon[uid],
+			*[counts[uid] for counts in self.counts],
+			*[dates[uid] for attr in range(len(Attrs)) for dates in (self.oldest[attr], self.newest[attr])]]
+			for uid, name in enumerate(self.names)}
+
+	def load(self, data):
+		for name, (anon, *values) in data.items():
+			uid = self.add(name, anon)
+			for attr in range(len(Attrs)):
+				self.counts[attr][uid] = values[attr]
+				self.oldest[attr][uid] = values[3 + 2*attr]
+				self.newest[attr][uid] = values[4 + 2*attr]
+
+	Sort_Columns = {
+		ARTICLES: (ARTICLES, AUTHORED, CONTRIBS),
+		AUTHORED: (AUTHORED, CONTRIBS, ARTICLES),
+		CONTRIBS: (CONTRIBS, AUTHORED, ARTICLES),
+	}
+
+	def sortkey(self, attr):
+		a, b, c = [self.counts[column] for column in self.Sort_Columns[attr]]
+		names = self.names
+		return lambda uid: (a[uid], b[uid], c[uid], names[uid])
+
+	def print_stats(self, attr, top=20):
+		attr_name = attr
+		attr = Attrs.index(attr)
+		articles, authored, contribs = self.counts
+		oldest = self.oldest[attr]
+		newest = self.newest[attr]
+
+		uids = range(len(self))
+		if attr == AUTHORED:
+			uids = [uid for uid in uids if authored[uid]]
+
+		n = len(uids)
+		total_authored = sum(authored)
+		total_contribs = sum(contribs[uid] for uid in uids) if attr == AUTHORED else sum(contribs)
+		total_oldest = min(oldest[uid] for uid in uids) if uids else No_Oldest
+		total_newest = max(newest[uid] for uid in uids) if uids else No_Newest
 
-	@classmethod
-	def print_stats(self, attr):
-		sortkey = self.sortkey.get(attr)
-		if not sortkey:
-			log('No sortkey for attr "{}"', attr)
-			return
-		attr_authored = attr == 'authored'
-		oldest_attr = 'date_oldest_' + attr
-		newest_attr = 'date_newest_' + attr
-		total_oldest = None
-		total_newest = None
 		print('+---------------------------------------+')
-		print('|', ('Most ' + attr).center(37), '|')
+		print('|', ('Most ' + attr_name).center(37), '|')
 		print('+------+----------+----------+----------+---------------------+---------------------+')
 		print('| Rank | Articles | Authored | Contribs |       Oldest        |       Newest        |')
 		print('+------+----------+----------+----------+---------------------+---------------------+')
-		n = 0
-		total_authored = 0
-		total_contribs = 0
-		for user in sorted(self.name2user.values(), key=sortkey, reverse=True):
-			if user.num_authored == 0:
-				if attr_authored: break
-			else:
-				total_authored += user.num_authored
-			total_contribs += user.num_contribs
-			n += 1
-			user_oldest = getattr(user, oldest_attr)
-			user_newest = getattr(user, newest_attr)
-			if total_oldest is None or user_oldest < total_oldest:
-				total_oldest = user_oldest
-			if total_newest is None or total_newest < user_newest:
-				total_newest = user_newest
-			if n > 20:
-				continue
-			print('|{:5} |{:9,} |{:9,} |{:9,} | {} | {} | {}'.format(n,
-				user.num_articles,
-				user.num_authored,
-				user.num_contribs,
-				date2str(user_oldest),
-				date2str(user_newest),
-				user.name))
+		for rank, uid in enumerate(heapq.nlargest(top, uids, key=self.sortkey(attr)), start=1):
+			print('|{:5} |{:9,} |{:9,} |{:9,} | {} | {} | {}'.format(rank,
+				articles[uid],
+				authored[uid],
+				contribs[uid],
+				date2str(oldest[uid]),
+				date2str(newest[uid]),
+				self.names[uid]))
 		print('+-----------------+----------+----------+---------------------+---------------------+')
 		print('| {:9,} users |{:9,} |{:9,} | {} | {} |'.format(n,
 			total_authored,
@@ -108,22 +146,126 @@ class User(object):
 		print('+-----------------+----------+----------+---------------------+---------------------+')
 
 class Year(object):
-	name2year = {}
-
 	def __init__(self):
 		self.num_articles = 0
 		self.num_authored = 0
 		self.num_contribs = 0
 
+	def dump(self):
+		return [self.num_articles, self.num_authored, self.num_contribs]
+
 	@classmethod
-	def get(self, name):
-		year = self.name2year.get(name)
-		if not year:
-			self.name2year[name] = year = self()
+	def load(self, data):
+		year = self()
+		year.num_articles, year.num_authored, year.num_contribs = data
 		return year
 
+class Page(object):
+	def __init__(self, title):
+		self.title = title
+		self.last_revid = None
+		self.last_date = None
+		self.users = set()
+		self.years = set()
+
+	def add_revisions(self, stats, revisions):
+		# Revisions up to (last_date, last_revid) have already been counted.
+		# Revisions come in (timestamp, revid) order, but after history merges
+		# and imports the revids alone needn't increase. Keeping the set of
+		# users and years per page allows later runs to add only the newer
+		# revisions and still count each article once per user/year.
+		for revid, date, name, anon in revisions:
+			if self.last_revid is not None and (date, revid) <= (self.last_date, self.last_revid):
+				continue
+			uid = stats.users.get(name, anon)
+			year_name = date2year(date)
+			year = stats.get_year(year_name)
+			if self.last_revid is None:
+				stats.users.inc(uid, AUTHORED, date)
+				year.num_authored += 1
+			stats.users.inc(uid, CONTRIBS, date)
+			year.num_contribs += 1
+			if name not in self.users:
+				stats.users.inc(uid, ARTICLES, date)
+				self.users.add(name)
+			if year_name not in self.years:
+				year.num_articles += 1
+				self.years.add(year_name)
+			self.last_revid = revid
+			self.last_date = date
+
+	def dump(self):
+		return [self.last_revid, self.last_date, sorted(self.users), sorted(self.years)]
+
 	@classmethod
-	def print_stats(self):
+	def load(self, title, data):
+		page = self(title)
+		page.last_revid, page.last_date, users, years = data
+		page.users = set(users)
+		page.years = set(years)
+		return page
+
+class Stats(object):
+	# The users, years and pages counted for one page selector, or for the
+	# union of several selectors (in which case the selector is a tuple of
+	# selectors and each page is counted only once).
+
+	def __init__(self, selector):
+		self.selector = selector
+		self.users = UserTable()
+		self.years = {}
+		self.pages = {}
+		self.references = {}
+
+	def name(self):
+		if isinstance(self.selector[0], str):
+			return '{}:{}'.format(*self.selector)
+		return 'Combined'
+
+	def key(self):
+		if isinstance(self.selector[0], str):
+			return list(self.selector)
+		return [list(selector) for selector in self.selector]
+
+	def get_year(self, name):
+		year = self.years.get(name)
+		if not year:
+			self.years[name] = year = Year()
+		return year
+
+	def get_page(self, title):
+		page = self.pages.get(title)
+		if not page:
+			self.pages[title] = page = Page(title)
+		return page
+
+	def select(self, references):
+		# Returns the selected pages whose last revision hasn't been counted yet.
+		pages = []
+		for title, revid in references.items():
+			page = self.get_page(title)
+			if page.last_revid != revid:
+				pages.append(page)
+		for title in self.pages.keys() - references.keys():
+			log('Revisions of "{}" are still counted but it is no longer selected', title)
+		return pages
+
+	def dump(self):
+		return {
+			'selector': self.key(),
+			'users': self.users.dump(),
+			'years': {name: year.dump() for name, year in self.years.items()},
+			'pages': {title: page.dump() for title, page in self.pages.items()},
+		}
+
+	def load(self, state):
+		self.users.load(state['users'])
+		for name, data in state['years'].items():
+			self.years[int(name)] = Year.load(data)
+		for title, data in state['pages'].items():
+			self.pages[title] = Page.load(title, data)
+
+	def print_years(self):
 		print('+--------------------------------+')
 		print('|             Years              |')
 		print('+----------+----------+----------+')
@@ -131,7 +273,7 @@ class Year(object):
 		print('+----------+----------+----------+')
 		total_authored = 0
 		total_contribs = 0
-		for name, year in sorted(self.name2year.items(), reverse=True):
+		for name, year in sorted(self.years.items(), reverse=True):
 			total_authored += year.num_authored
 			total_contribs += year.num_contribs
 			print('|{:9,} |{:9,} |{:9,} | {}'.format(
@@ -142,12 +284,134 @@ class Year(object):
 		print('|   Total: |{:9,} |{:9,} |'.format(total_authored, total_contribs))
 		print('+----------+----------+----------+')
 
-Namespace = pywikibot.site.Namespace
-
-def get_pages(sitecode, template, total=None):
-	site = pywikibot.Site(code=sitecode)
-	return pywikibot.Page(site, template, ns=Namespace.TEMPLATE).getReferences(
-		only_template_inclusion=True, namespaces=(Namespace.MAIN,), total=total)
+	def print_stats(self):
+		self.print_years()
+		self.users.print_stats('contribs')
+		self.users.print_stats('authored')
+		self.users.print_stats('articles')
+
+def read_state(filename):
+	# The state file holds one entry per selector (and per combination of
+	# selectors). A state file written for a single selector is one entry.
+	if not os.path.exists(filename):
+		return []
+	with open(filename) as f:
+		state = json.load(f)
+	if isinstance(state, dict):
+		return [state]
+	return state
+
+def load_state(filename, stats_list):
+	entries = read_state(filename)
+	for stats in stats_list:
+		key = stats.key()
+		for entry in entries:
+			if entry['selector'] == key:
+				stats.load(entry)
+				break
+
+def save_state(filename, stats_list):
+	# Entries for selectors that weren't used in this run are kept as they are.
+	entries = [stats.dump() for stats in stats_list]
+	keys = [entry['selector'] for entry in entries]
+	entries.extend(entry for entry in read_state(filename) if entry['selector'] not in keys)
+	state = entries[0] if len(entries) == 1 else entries
+
+	temp_filename = filename + '.tmp'
+	with open(temp_filename, 'w') as f:
+		json.dump(state, f, ensure_ascii=False)
+	os.replace(temp_filename, filename)
+
+def get_pages(request, template, total=None):
+	pages = wiki_pages.references(request, 'Template:' + template)
+	return list(itertools.islice(pages, total))
+
+def get_revisions(request, title, start_revid=None):
+	params = {}
+	if start_revid:
+		params['rvstartid'] = start_revid
+	revisions = []
+	for result in wiki_pages.query(request,
+		titles=title,
+		prop='revisions',
+		rvprop='ids|timestamp|user',
+		rvdir='newer',
+		rvlimit='max',
+		**params,
+	):
+		for page in result.get('pages', ()):
+			for rev in page.get('revisions', ()):
+				revisions.append((rev['revid'], parse_timestamp(rev['timestamp']),
+					rev.get('user', ''), rev.get('anon', False)))
+	return revisions
+
+def fetch_revisions(request, pages, threads=1):
+	# The histories are fetched concurrently but handed to the aggregator
+	# in page order, so the totals are the same as for a sequential run.
+	# Each page is a (title, start_revid) pair.
+	def fetch(page):
+		return get_revisions(request, *page)
+	with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+		yield from zip(pages, executor.map(fetch, pages))
+
+def open_dump(filename):
+	if filename.endswith('.bz2'):
+		return bz2.open(filename)
+	if filename.endswith('.gz'):
+		return gzip.open(filename)
+	return open(filename, 'rb')
+
+def local_name(tag):
+	return tag.rpartition('}')[2]
+
+def read_dump(filename, pages):
+	# Streams the revisions of the given pages from a stub-meta-history (or
+	# pages-meta-history) XML dump. Each <page> element is cleared once it has
+	# been read, so only the revisions of the current page are kept in memory.
+	# Pages are yielded in dump order, like fetch_revisions yields them.
+	title2start = dict(pages)
+	with open_dump(filename) as f:
+		root = None
+		page = None
+		revision = None
+		for event, elem in ET.iterparse(f, events=('start', 'end')):
+			tag = local_name(elem.tag)
+			if event == 'start':
+				if root is None:
+					root = elem
+				elif tag == 'page':
+					page = None
+				elif tag == 'revision' and page is not None:
+					revision = {}
+				continue
+			if tag == 'title' and page is None:
+				title = elem.text
+				if title in title2start:
+					page = (title, title2start.pop(title))
+					revisions = []
+			elif revision is None:
+				if tag == 'page':
+					if page is not None:
+						# Like the API (rvdir=newer, rvstartid), in (timestamp, revid)
+						# order from the timestamp of the start revision on
+						revisions.sort(key=lambda rev: (rev[1], rev[0]))
+						start_revid = page[1]
+						if start_revid:
+							start_dates = [date for revid, date, name, anon in revisions if revid == start_revid]
+							if start_dates:
+								revisions = [rev for rev in revisions if rev[1] >= start_dates[0]]
+						yield page, revisions
+						page = None
+					root.clear()
+			elif tag == 'revision':
+				revisions.append((revision['id'], parse_timestamp(revision['timestamp']),
+					revision.get('username', revision.get('ip', '')), 'ip' in revision))
+				revision = None
+			elif tag in ('id', 'timestamp', 'username', 'ip'):
+				# The contributor also has an <id>, which comes after the revision's.
+				revision.setdefault(tag, int(elem.text) if tag == 'id' else elem.text or '')
+	for title in title2start:
+		log('"{}" was not found in "{}"', title, filename)
 
 def parse_total(value):
 	value = int(value)
@@ -155,12 +419,22 @@ def parse_total(value):
 		raise ValueError('must be >= 0')
 	return value
 
+def parse_threads(value):
+	value = int(value)
+	if value < 1:
+		raise ValueError('must be >= 1')
+	return value
+
 def parse_args(args):
 	param_pattern = re.compile('^[a-z]+=')
 	short_selector_pattern = re.compile('^[a-z][-0-9a-z]*$')
 	selector_pattern = re.compile('^([a-z]{2}):([A-Z][- 0-9A-Za-z]*)$')
 
 	valid_params = {
+		'dump': str,
+		'metrics': str,
+		'state': str,
+		'threads': parse_threads,
 		'total': parse_total,
 	}
 	valid_selectors = {
@@ -169,7 +443,7 @@ def parse_args(args):
 	}
 
 	params = {}
-	selector = None
+	selectors = []
 
 	for arg in args:
 		m = param_pattern.match(arg)
@@ -186,66 +460,101 @@ def parse_args(args):
 				err('Invalid value for command-line parameter "{}"', param)
 			continue
 
-		if selector:
-			err('Please specify only one page selector.')
-
 		m = short_selector_pattern.match(arg)
 		if m:
-			selector = arg
+			selector = valid_selectors.get(arg)
+			if not selector:
+				err('Invalid page selector!')
+			selectors.append(selector)
 			continue
 
 		m = selector_pattern.match(arg)
 		if m:
-			selector = m.groups()
+			selectors.append(m.groups())
 			continue
 
 		err('Invalid command-line argument "{}"', arg)
 
-	if not selector:
-		selector = 'tatort'
-	if isinstance(selector, str):
-		selector = valid_selectors.get(selector)
-		if not selector:
-			err('Invalid page selector!')
-
-	return (selector, params)
+	if not selectors:
+		selectors.append(valid_selectors['tatort'])
+	if len(set(selectors)) != len(selectors):
+		err('Please specify each page selector only once.')
+	if len(set(sitecode for sitecode, template in selectors)) != 1:
+		err('All page selectors must be for the same wiki.')
+
+	return (selectors, params)
+
+def main(args, request=None):
+	selectors, params = parse_args(args)
+	sitecode = selectors[0][0]
+	stats_list = [Stats(selector) for selector in selectors]
+	if len(selectors) > 1:
+		stats_list.append(Stats(tuple(selectors)))
+	state = params.get('state')
+	if state:
+		load_state(state, stats_list)
+	if request is None:
+		request = wiki_pages.site_request(pywikibot.Site(code=sitecode))
+	metrics = None
+	if 'metrics' in params:
+		metrics = wiki_pages.Metrics('rev-stats', params['metrics'])
+		request = wiki_pages.metered_request(request, metrics)
+		metrics.start()
+
+	total = params.get('total')
+	references = {}
+	for stats in stats_list[:len(selectors)]:
+		stats.references = dict(get_pages(request, stats.selector[1], total))
+		references.update(stats.references)
+	if len(selectors) > 1:
+		stats_list[-1].references = references
+
+	# A page selected by several selectors (and counted again for their
+	# union) is fetched only once, starting from the oldest revision
+	# that any of its stats hasn't counted yet. The API returns the
+	# revisions from the timestamp of that revision on.
+	title2pages = {}
+	for stats in stats_list:
+		for page in stats.select(stats.references):
+			title2pages.setdefault(page.title, []).append(page)
+
+	pages = []
+	for title, page_list in title2pages.items():
+		start_revid = None
+		if all(page.last_revid for page in page_list):
+			start_revid = min((page.last_date, page.last_revid) for page in page_list)[1]
+		pages.append((title, start_revid))
+	if metrics:
+		metrics.add_total(len(pages))
+		metrics.add_cache(len(references) - len(pages), len(pages))
+
+	dump = params.get('dump')
+	if dump:
+		revision_source = read_dump(dump, pages)
+	else:
+		revision_source = fetch_revisions(request, pages, params.get('threads', 1))
 
-def main(args):
-	args, kwargs = parse_args(args)
 	n = 0
-	for page in get_pages(*args, **kwargs):
+	for (title, start_revid), revisions in revision_source:
 		n += 1
-		log('{:,} | {}', n, page.title())
-		revisions = page.revisions(reverse=True, starttime=None, endtime=None)
-		rev = next(revisions)
-		date = rev.timestamp
-		user = User.get(rev.user, rev.anon)
-		user.inc_articles(date)
-		user.inc_authored(date)
-		user.inc_contribs(date)
-		users = {user}
-		year = Year.get(date.year)
-		year.num_articles += 1
-		year.num_authored += 1
-		year.num_contribs += 1
-		years = {year}
-		for rev in revisions:
-			date = rev.timestamp
-			user = User.get(rev.user, rev.anon)
-			user.inc_contribs(date)
-			if user not in users:
-				user.inc_articles(date)
-				users.add(user)
-			year = Year.get(date.year)
-			year.num_contribs += 1
-			if year not in years:
-				year.num_articles += 1
-				years.add(year)
-
-	Year.print_stats()
-	User.print_stats('contribs')
-	User.print_stats('authored')
-	User.print_stats('articles')
+		log('{:,} | {}', n, title)
+		if metrics:
+			metrics.add_pages(1, len(revisions))
+		for stats in stats_list:
+			page = stats.pages.get(title)
+			if page and title in stats.references:
+				page.add_revisions(stats, revisions)
+
+	if metrics:
+		metrics.stop()
+	if state:
+		save_state(state, stats_list)
+
+	for stats in stats_list:
+		if len(stats_list) > 1:
+			print()
+			print(stats.name())
+		stats.print_stats()
 
 if __name__ == '__main__':
 	main(sys.argv[1:])
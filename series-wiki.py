@@ -0,0 +1,26 @@
+import os
+import sys
+import tatort_wiki_lib as TW
+
+Series_Scripts = {
+	'tatort': 'tatort-wiki.py',
+	'polizeiruf110': 'polizeiruf110-wiki.py',
+}
+
+def load_series(name):
+	path = os.path.join(os.path.dirname(os.path.abspath(__file__)), Series_Scripts[name])
+	return TW.load_module(name + '_wiki', path).Series
+
+def main(args):
+	names = [arg for arg in args if '=' not in arg] or list(Series_Scripts)
+	for name in names:
+		if name not in Series_Scripts:
+			TW.err('Please specify {}', ' and/or '.join(Series_Scripts))
+	if len(set(names)) != len(names):
+		TW.err('Please specify each series only once')
+
+	params = TW.parse_args([arg for arg in args if '=' in arg])
+	TW.run_series([load_series(name) for name in names], params)
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -1,37 +1,15 @@
 import re
+import sys
 import tatort_wiki_lib as TW
+from episode_urls import title2url
 
 log = TW.log
 
-Replace_With_Dash = re.compile('[^0-9a-z]+')
-Translation_Table = str.maketrans({
-	'ä': 'ae',
-	'ö': 'oe',
-	'ü': 'ue',
-	'ß': 'ss',
-	'â': 'a',
-	'à': 'a',
-	'é': 'e',
-	'ô': 'o',
-	'\u2019': None, # apostrophe (right single quotation mark)
-})
-
-def title2url(title):
-	url = title.lower().translate(Translation_Table)
-	url = Replace_With_Dash.sub('-', url)
-
-	if url[0] == '-':
-		url = url[1:]
-	if url[-1] == '-':
-		url = url[:-1]
-
-	return url
-
-TW.Special_Dates = {
+Special_Dates = {
 	('Tatort: Schock', 'Premiere'): ('22. [[Jänner]] 2017', '2017-01-22'),
 	('Zabou (Film)', 'Premiere'): ('1990-07-22', '1990-07-22'),
 }
-TW.Alternate_Infobox_Dates = {
+Alternate_Infobox_Dates = {
 	'Tatort: Exklusiv!': ('1969-10-26', '1971-07-11'),
 	'Tatort: Mord hinterm Deich': ('1996-12-25', '1997-06-08'),
 	'Tatort: Time-Out': ('2001-09-23', '2002-12-22'),
@@ -39,7 +17,7 @@ TW.Alternate_Infobox_Dates = {
 	'Tatort: Der Polizistinnenmörder': ('2010-01-03', '2010-01-17'),
 	'Tatort: Die Amme': ('2021-03-14', '2021-03-28'),
 }
-TW.Alternate_Titles = {
+Alternate_Titles = {
 	'Tatort: Acht, neun – aus': 'Acht, neun – aus!',
 	'Tatort: Aus der Traum (2006)': 'Aus der Traum …',
 	'Tatort: Die schlafende Schöne': 'Die Schlafende Schöne',
@@ -53,20 +31,6 @@ TW.Alternate_Titles = {
 	'Tatort: … es wird Trauer sein und Schmerz': '... es wird Trauer sein und Schmerz',
 }
 
-def parse_date_after(info, param, extra):
-	if extra == ' (nur ORF)':
-		if param == 'VG-DATUM':
-			info.prev_orf = True
-			return True
-		if param == 'NF-DATUM':
-			info.next_orf = True
-			return True
-	elif param == 'Sender':
-		return extra == ' ebd. (Teil 2)'
-	return False
-
-TW.parse_date_after = parse_date_after
-
 class TatortInfo(object):
 	def __init__(self, page_name):
 		self.page_name = page_name
@@ -100,12 +64,6 @@ class TatortInfo(object):
 			return ep, 0
 		return None
 
-TW.Infobox_Series_Params.extend((
-	('Serie',         True,  'Tatort (Fernsehreihe)'),
-	('Serienlogo',    False, 'Tatort Logo mini.svg'),
-	('Episodenliste', True,  'Liste der Tatort-Folgen'),
-))
-
 def do_infobox_film(info, params):
 	if not TW.get_infobox_title(info, params):
 		return
@@ -129,6 +87,10 @@ Tatort_Fans_URL_Map = {}
 Tatort_Folge_URL_Map = {}
 
 def load_url_map(filename, lookup):
+	if TW.Episode_DB is not None:
+		for ep, url in TW.Episode_DB.url_map(filename):
+			lookup[str(ep)] = url
+		return
 	with open(filename) as f:
 		for line in f:
 			ep, url = line.split('|', maxsplit=1)
@@ -251,49 +213,84 @@ def check_info(info, page):
 		log(info, 'Missing Tatort-Folge')
 		info.tatort_folge = ('', '') if info.double_episode else ''
 
-def main():
-	load_url_map('tatort-fans-url-map.txt', Tatort_Fans_URL_Map)
-	load_url_map('tatort-folge-url-map.txt', Tatort_Folge_URL_Map)
-
-	info_list = TW.process_pages(TatortInfo, check_info,
+class TatortSeries(TW.SeriesConfig):
+	name = 'Tatort'
+	info_class = TatortInfo
+	template_actions = (
 		('Infobox Film', do_infobox_film),
 		('Tatort-Fans', do_tatort_fans),
-		('Tatort-Folge', do_tatort_folge))
-
-	next_ep = (1, 0)
-	prev = None
-
-	for info in info_list:
-		ep = info.sortkey
-		if ep != next_ep:
-			log(info, 'Unexpected episode number|{}|{}', ep2str(ep), ep2str(next_ep))
-		elif prev:
-			if prev.orf != info.prev_orf:
-				log(info, '{}xpected " (nur ORF)" after prev_ep_date', 'E' if prev.orf else 'Une')
-			if info.orf != prev.next_orf:
-				log(prev, '{}xpected " (nur ORF)" after next_ep_date', 'E' if info.orf else 'Une')
-			TW.check_attrs(info, 'prev', prev)
-			TW.check_attrs(prev, 'next', info)
-		else:
-			TW.check_attr(info, 'prev_episode', TW.EnDash)
-			TW.check_attr(info, 'prev_ep_date', '')
+		('Tatort-Folge', do_tatort_folge),
+	)
+	special_dates = Special_Dates
+	alternate_infobox_dates = Alternate_Infobox_Dates
+	alternate_titles = Alternate_Titles
+	infobox_params = TW.SeriesConfig.infobox_params + (
+		('Serie',         True,  'Tatort (Fernsehreihe)'),
+		('Serienlogo',    False, 'Tatort Logo mini.svg'),
+		('Episodenliste', True,  'Liste der Tatort-Folgen'),
+	)
+	store_inputs = ('tatort-fans-url-map.txt', 'tatort-folge-url-map.txt')
+	first_sortkey = (1, 0)
+	no_episode = TW.EnDash
+
+	def setup(self):
+		with TW.profile_phase('load url maps'):
+			Tatort_Fans_URL_Map.clear()
+			Tatort_Folge_URL_Map.clear()
+			load_url_map('tatort-fans-url-map.txt', Tatort_Fans_URL_Map)
+			load_url_map('tatort-folge-url-map.txt', Tatort_Folge_URL_Map)
+
+	def worker_state(self):
+		return Tatort_Fans_URL_Map, Tatort_Folge_URL_Map
+
+	def load_worker_state(self, state):
+		fans_map, folge_map = state
+		Tatort_Fans_URL_Map.update(fans_map)
+		Tatort_Folge_URL_Map.update(folge_map)
+
+	def check_page(self, info, page):
+		check_info(info, page)
+
+	def parse_date_after(self, info, param, extra):
+		if extra == ' (nur ORF)':
+			if param == 'VG-DATUM':
+				info.prev_orf = True
+				return True
+			if param == 'NF-DATUM':
+				info.next_orf = True
+				return True
+		return super().parse_date_after(info, param, extra)
+
+	def next_sortkey(self, info):
+		ep, orf = info.sortkey
+		if info.double_episode:
+			ep += 1
+		return (ep, orf + 1) if info.next_orf else (ep + 1, 0)
+
+	def ep2str(self, ep):
+		return ep2str(ep)
 
-		ep, orf = ep
+	def check_pair(self, prev, info):
+		if prev.orf != info.prev_orf:
+			log(info, '{}xpected " (nur ORF)" after prev_ep_date', 'E' if prev.orf else 'Une')
+		if info.orf != prev.next_orf:
+			log(prev, '{}xpected " (nur ORF)" after next_ep_date', 'E' if info.orf else 'Une')
+		super().check_pair(prev, info)
+
+	def write_episodes(self, info):
+		ep, orf = info.sortkey
 		if info.double_episode:
 			name = info.episode_name
 			urls = info.tatort_folge
-			print(ep, info.infobox_date, name + ' (1)', urls[0], sep='|')
-			print(ep+1, info.part2_date, name + ' (2)', urls[1], sep='|')
-			ep += 1
+			TW.write_episode(ep, info.infobox_date, name + ' (1)', urls[0])
+			TW.write_episode(ep+1, info.part2_date, name + ' (2)', urls[1])
 		elif not orf:
-			print(info.episode_number, info.infobox_date, info.episode_name, info.tatort_folge, sep='|')
+			TW.write_episode(info.episode_number, info.infobox_date, info.episode_name, info.tatort_folge)
 
-		next_ep = (ep, orf + 1) if info.next_orf else (ep + 1, 0)
-		prev = info
+Series = TatortSeries()
 
-	if prev:
-		TW.check_attr(prev, 'next_episode', TW.EnDash)
-		TW.check_attr(prev, 'next_ep_date', '')
+def main(args):
+	TW.run_series([Series], TW.parse_args(args))
 
 if __name__ == '__main__':
-	main()
+	main(sys.argv[1:])
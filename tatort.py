@@ -1,43 +1,66 @@
+import contextlib
+import episode_db
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import os
 import os.path
-import random
 import re
-import subprocess
+import socket
 import sys
 import time
+import traceback
+import types
+import urllib.error
+import urllib.parse
+import urllib.request
+from episode_urls import read_url_map, title2url
 
 class TatortSpec(object):
+	series = 'tatort'
 	html = 'tatort.html'
 	url = 'https://www.daserste.de/unterhaltung/krimi/tatort/sendung/index.html'
 	prefix = 'Tatort: '
 	title_map = 'tatort-title-map.txt'
 	wiki_episodes = 'tatort-wiki-episodes.txt'
-	skip = set((
+	fans = True
+	fans_url_map = 'tatort-fans-url-map.txt'
+	folge_url_map = 'tatort-folge-url-map.txt'
+	fundus_url_map = 'tatort-fundus-url-map.txt'
+	skip = frozenset((
 		('2016-11-13', 'Sonntagsmörder', 'sonntagsmoerder-106'),
 	))
-	change_date = {
+	change_date = types.MappingProxyType({
 		('2014-12-12', 'Der Maulwurf'): '2014-12-21',
 		('1980-02-17', 'Der gelbe Unterrock'): '1980-02-10',
 		('1979-06-14', 'Ein Schuss zuviel'): '1979-06-04',
-	}
+	})
 	add = (
 		('2020-11-29', 'In der Familie (1)', ''),
 		('2020-12-06', 'In der Familie (2)', ''),
 	)
 
 class PolizeirufSpec(object):
+	series = 'polizeiruf110'
 	html = 'polizeiruf110.html'
 	url = 'https://www.daserste.de/unterhaltung/krimi/polizeiruf-110/sendung/index.html'
 	prefix = 'Polizeiruf 110: '
 	title_map = 'polizeiruf110-title-map.txt'
 	wiki_episodes = 'polizeiruf110-wiki-episodes.txt'
-	skip = set((
+	fans = False
+	fans_url_map = None
+	folge_url_map = None
+	fundus_url_map = None
+	skip = frozenset((
 		('1985-01-27', 'Außenseiter', 'aussenseiter-100'),
 		('2011-06-23', 'Im Alter von ...', 'im-alter-von-100'),
 		('2021-05-30', 'Polizeiruf 110 - Die Krimidokumentation', 'die-krimidokumentation-100'),
 	))
-	change_date = {
+	change_date = types.MappingProxyType({
 		('2012-04-18', 'Raubvögel'): '2012-03-18',
-	}
+	})
 	add = (
 		('1979-12-02', 'Die letzte Fahrt', ''),
 	)
@@ -50,9 +73,9 @@ def err(*args, **kwargs):
 	sys.exit()
 
 class InputFile(object):
-	def __init__(self, fileName):
+	def __init__(self, fileName, fileObject=None):
 		self.lineNumber = 0
-		self.fileObject = open(fileName)
+		self.fileObject = fileObject or open(fileName)
 
 	def close(self):
 		self.fileObject.close()
@@ -74,29 +97,8 @@ class InputFile(object):
 
 	next = __next__
 
-REPLACE_WITH_DASH = re.compile('[^0-9a-z]+')
-TRANSLATION_TABLE = str.maketrans({
-	'ä': 'ae',
-	'ö': 'oe',
-	'ü': 'ue',
-	'ß': 'ss',
-	'â': 'a',
-	'à': 'a',
-	'é': 'e',
-	'ô': 'o',
-	'\u2019': None, # apostrophe (right single quotation mark)
-})
-
-def title2url(title):
-	url = title.lower().translate(TRANSLATION_TABLE)
-	url = REPLACE_WITH_DASH.sub('-', url)
-
-	if url[0] == '-':
-		url = url[1:]
-	if url[-1] == '-':
-		url = url[:-1]
-
-	return url
+User_Agent = 'tatort-wikibot (https://github.com/nightjuggler/tatort-wikibot)'
+Fans_Base_URL = 'https://tatort-fans.de/category/'
 
 def fans_html_url(start=None, end=None):
 	if not start:
@@ -116,9 +118,23 @@ def fans_html_url(start=None, end=None):
 		year_str = str(year)
 		yield (
 			'tatort-fans/' + year_str + '.html',
-			'https://tatort-fans.de/category/' + url + '/' + year_str + '/',
+			Fans_Base_URL + url + '/' + year_str + '/',
 		)
 
+def fans_page_url(html, url, page):
+	if page == 1:
+		return html, url
+	return html[:-5] + '-' + str(page) + '.html', url + 'page/' + str(page) + '/'
+
+def fans_year_pages(html, url):
+	page = 1
+	while True:
+		page_html, page_url = fans_page_url(html, url, page)
+		if not os.path.exists(page_html):
+			break
+		yield page_html, page_url
+		page += 1
+
 def fans_read_html():
 	episode_number_errors = {
 		'45-der-schwarze-skorpion': 456,
@@ -129,9 +145,8 @@ def fans_read_html():
 	episode_number_pattern = re.compile('^(?:[1-9][0-9]{1,3}|0[0-9]{2})-')
 	episodes = []
 
-	for html, url in fans_html_url():
-		if not os.path.exists(html):
-			continue
+	for html, url in itertools.chain.from_iterable(
+		fans_year_pages(html, url) for html, url in fans_html_url()):
 		with InputFile(html) as f:
 			for line in f:
 				if 'entry-title' not in line:
@@ -163,6 +178,12 @@ def fans_read_html():
 	return episodes
 
 def fans_urlmap():
+	if Episode_DB:
+		with open_db(TatortSpec, fans=True) as db:
+			for ep, url in db.fans_urlmap_rows(TatortSpec.series):
+				print(ep, url, sep='|')
+		return
+
 	wiki_titles = {}
 	with InputFile(TatortSpec.wiki_episodes) as f:
 		for line in f:
@@ -177,8 +198,12 @@ def fans_urlmap():
 			print(ep, url, sep='|')
 
 def fans_html2txt():
-	for ep, url in fans_read_html():
+	episodes = fans_read_html()
+	for ep, url in episodes:
 		print(ep, url, sep='|')
+	if Episode_DB:
+		with episode_db.EpisodeDB(Episode_DB) as db:
+			db.write_fans_episodes(episodes)
 
 def parse_fans_year(arg, arg_name, min_year, max_year):
 	try:
@@ -206,25 +231,187 @@ def parse_fans_fetch_args(args):
 
 	err('Too many command-line arguments!')
 
+class TokenBucket(object):
+	def __init__(self, rate, capacity):
+		self.rate = rate
+		self.capacity = capacity
+		self.tokens = capacity
+		self.time = time.monotonic()
+
+	def acquire(self):
+		now = time.monotonic()
+		self.tokens = min(self.capacity, self.tokens + (now - self.time) * self.rate)
+		self.time = now
+		if self.tokens < 1:
+			sleep_time = (1 - self.tokens) / self.rate
+			log('Sleeping for {:.1f} seconds', sleep_time)
+			time.sleep(sleep_time)
+			self.tokens = 1
+			self.time = time.monotonic()
+		self.tokens -= 1
+
+class Scheduler(object):
+	# One token bucket per host, so requests to a host never exceed the
+	# rate (requests per second) after an initial burst of capacity.
+	def __init__(self, rate, capacity=1):
+		self.rate = rate
+		self.capacity = capacity
+		self.buckets = {}
+
+	def acquire(self, url):
+		host = urllib.parse.urlsplit(url).netloc
+		bucket = self.buckets.get(host)
+		if not bucket:
+			self.buckets[host] = bucket = TokenBucket(self.rate, self.capacity)
+		bucket.acquire()
+
+class FansJournal(object):
+	# Keeps the ETag/Last-Modified validators of every fetched page and
+	# the years already done in an unfinished run, so that a failed run
+	# can be resumed.
+	filename = 'tatort-fans/journal.json'
+
+	def __init__(self):
+		self.validators = {}
+		self.run = None
+		self.done = set()
+		if os.path.exists(self.filename):
+			with open(self.filename) as f:
+				journal = json.load(f)
+			self.validators = journal['validators']
+			self.run = journal['run']
+			self.done = set(journal['done'])
+
+	def save(self):
+		journal = {
+			'validators': self.validators,
+			'run': self.run,
+			'done': sorted(self.done),
+		}
+		temp_filename = self.filename + '.tmp'
+		with open(temp_filename, 'w') as f:
+			json.dump(journal, f, indent='\t')
+		os.replace(temp_filename, self.filename)
+
+	def start(self, start, end):
+		run = [start, end]
+		if self.run == run:
+			return
+		self.run = run
+		self.done = set()
+
+def conditional_get(scheduler, validators, html, url):
+	headers = {'User-Agent': User_Agent}
+	etag, last_modified = validators.get(url, (None, None))
+	if os.path.exists(html):
+		if etag:
+			headers['If-None-Match'] = etag
+		if last_modified:
+			headers['If-Modified-Since'] = last_modified
+
+	if scheduler:
+		scheduler.acquire(url)
+	log('GET {}', url)
+	try:
+		with urllib.request.urlopen(urllib.request.Request(url, headers=headers)) as response:
+			content = response.read()
+			response_validators = (response.headers.get('ETag'), response.headers.get('Last-Modified'))
+	except urllib.error.HTTPError as e:
+		if e.code == 304:
+			return False
+		raise
+
+	temp_html = html + '.tmp'
+	with open(temp_html, 'wb') as f:
+		f.write(content)
+	os.replace(temp_html, html)
+	validators[url] = response_validators
+	return True
+
+def retry_http_error(e):
+	# Server errors and throttling are worth retrying. Any other HTTP error
+	# (like 404 for the listing of a year that hasn't started yet) means
+	# that there is nothing to list.
+	return e.code >= 500 or e.code == 429
+
+def fans_fetch_year(scheduler, journal, html, url):
+	page = 1
+	while True:
+		page_html, page_url = fans_page_url(html, url, page)
+		try:
+			if not conditional_get(scheduler, journal.validators, page_html, page_url):
+				if page == 1:
+					log('{} is unchanged', url)
+					return
+		except urllib.error.HTTPError as e:
+			if retry_http_error(e):
+				raise
+			log('{} returned {}, no (more) episodes listed', page_url, e.code)
+			journal.validators.pop(page_url, None)
+			page -= 1
+			break
+		with open(page_html) as f:
+			if fans_page_url(html, url, page + 1)[1] not in f.read():
+				break
+		page += 1
+
+	# Remove listing pages left over from an earlier run with more pages
+	while True:
+		page += 1
+		page_html, page_url = fans_page_url(html, url, page)
+		if not os.path.exists(page_html):
+			break
+		os.remove(page_html)
+
+Fans_Request_Rate = 1 / 7.5
+
 def fans_fetch(args):
 	start, end = parse_fans_fetch_args(args)
 
-	rc = 1
+	os.makedirs('tatort-fans', exist_ok=True)
+	scheduler = Scheduler(Fans_Request_Rate)
+	journal = FansJournal()
+	journal.start(start, end)
+	failed = []
+
 	for html, url in fans_html_url(start, end):
-		if rc == 0:
-			sleep_time = int(random.random() * 5 + 5.5)
-			print('Sleeping for', sleep_time, 'seconds', file=sys.stderr)
-			time.sleep(sleep_time)
+		if url in journal.done:
+			log('Skipping {} (already fetched in this run)', url)
+			continue
+		try:
+			fans_fetch_year(scheduler, journal, html, url)
+		except (OSError, urllib.error.URLError) as e:
+			log('Failed to fetch {}: {}', url, e)
+			failed.append(url)
+			continue
+		journal.done.add(url)
+		journal.save()
 
-		command = ['/usr/bin/curl', '-o', html, url]
-		print(*command, file=sys.stderr)
-		rc = subprocess.call(command)
-		if rc != 0:
-			err('Exit code', rc)
+	if failed:
+		journal.save()
+		fans_html2txt()
+		err('Failed to fetch {} year(s). Run the same command again to retry them.', len(failed))
+
+	journal.run = None
+	journal.done = set()
+	journal.save()
 
 	fans_html2txt()
 
-def read_html(spec):
+def open_url(url):
+	# The response is decoded and split into lines as the chunks arrive,
+	# so the caller can parse the beginning while the rest is downloading.
+	request = urllib.request.Request(url, headers={'User-Agent': User_Agent})
+	response = urllib.request.urlopen(request)
+	charset = response.headers.get_content_charset('utf-8')
+	return InputFile(url, io.TextIOWrapper(response, encoding=charset))
+
+def parse_html(spec, html, messages):
+	def note(message, *args):
+		message = message.format(*args)
+		messages.append(message)
+		log('{}', message)
+
 	expected_prefix1 = '<select name="filterBoxTitle" '
 	expected_prefix2 = '<option value="/">Bitte '
 	expected_prefix3 = '</select>'
@@ -232,7 +419,9 @@ def read_html(spec):
 		' *([^ ]+(?: +[^ ]+)*) +\\(([0-9]{2}\\.[0-9]{2}\\.[0-9]{4})\\)</option>$')
 
 	episodes = []
-	with InputFile(spec.html) as f:
+	skipped = set()
+	changed = set()
+	with html as f:
 		for line in f:
 			if line.startswith(expected_prefix1):
 				break
@@ -257,18 +446,21 @@ def read_html(spec):
 			info = (date, title, url)
 
 			if info in spec.skip:
-				spec.skip.remove(info)
+				skipped.add(info)
 				continue
-			date = spec.change_date.pop((date, title), None)
-			if date:
-				info = (date, title, url)
+			new_date = spec.change_date.get((date, title))
+			if new_date:
+				changed.add((date, title))
+				info = (new_date, title, url)
 
 			episodes.append(info)
 
 	for date, title, url in spec.skip:
-		log('Could not skip "{}" ({}) {}', title, date, url)
+		if (date, title, url) not in skipped:
+			note('Could not skip "{}" ({}) {}', title, date, url)
 	for date, title in spec.change_date:
-		log('Could not change date for "{}" ({})', title, date)
+		if (date, title) not in changed:
+			note('Could not change date for "{}" ({})', title, date)
 
 	episodes.extend(spec.add)
 	if not episodes:
@@ -282,7 +474,7 @@ def read_html(spec):
 	for date, title, url in sorted_episodes:
 		if date == prev_date and title == prev_title:
 			if url in prev_url.split(','):
-				log('Skipping duplicate entry {}|{}|{}', date, title, url)
+				note('Skipping duplicate entry {}|{}|{}', date, title, url)
 				continue
 			prev_url += ',' + url
 		else:
@@ -292,7 +484,107 @@ def read_html(spec):
 	episodes.append((ep, prev_date, prev_title, prev_url))
 	return episodes
 
-def read_wiki(spec):
+class IndexCache(object):
+	# Kept next to the downloaded index: the HTTP validators for a
+	# conditional GET, and the parsed episode list together with the hash
+	# of the index and of the spec tables it was parsed with.
+	def __init__(self, spec):
+		self.filename = spec.html + '.cache.json'
+		self.validators = {}
+		self.html_hash = None
+		self.spec_hash = None
+		self.episodes = None
+		self.messages = []
+		if os.path.exists(self.filename):
+			with open(self.filename) as f:
+				cache = json.load(f)
+			self.validators = cache['validators']
+			self.html_hash = cache['html_hash']
+			self.spec_hash = cache['spec_hash']
+			self.episodes = cache['episodes']
+			self.messages = cache['messages']
+
+	def save(self):
+		cache = {
+			'validators': self.validators,
+			'html_hash': self.html_hash,
+			'spec_hash': self.spec_hash,
+			'episodes': self.episodes,
+			'messages': self.messages,
+		}
+		temp_filename = self.filename + '.tmp'
+		with open(temp_filename, 'w') as f:
+			json.dump(cache, f, ensure_ascii=False)
+		os.replace(temp_filename, self.filename)
+
+def file_hash(filename):
+	with open(filename, 'rb') as f:
+		return hashlib.sha256(f.read()).hexdigest()
+
+def spec_hash(spec):
+	tables = (spec.prefix, sorted(spec.skip), sorted(spec.change_date.items()), spec.add)
+	return hashlib.sha256(repr(tables).encode()).hexdigest()
+
+# Indexes already parsed by this process (e.g. by the daemon), keyed by
+# file name and checked against the file's modification time and size.
+Parsed_Indexes = {}
+
+def read_html(spec, html=None):
+	if html:
+		return parse_html(spec, html, [])
+
+	stat = os.stat(spec.html)
+	stat = (stat.st_mtime_ns, stat.st_size)
+	parsed = Parsed_Indexes.get(spec.html)
+	if parsed and parsed[0] == stat:
+		stat, episodes, messages = parsed
+		for message in messages:
+			log('{}', message)
+		return list(episodes)
+
+	cache = IndexCache(spec)
+	html_hash = file_hash(spec.html)
+	tables_hash = spec_hash(spec)
+	if cache.html_hash == html_hash and cache.spec_hash == tables_hash:
+		for message in cache.messages:
+			log('{}', message)
+		episodes = [tuple(info) for info in cache.episodes]
+		messages = cache.messages
+	else:
+		messages = []
+		episodes = parse_html(spec, InputFile(spec.html), messages)
+		cache.html_hash = html_hash
+		cache.spec_hash = tables_hash
+		cache.episodes = episodes
+		cache.messages = messages
+		cache.save()
+
+	Parsed_Indexes[spec.html] = (stat, episodes, messages)
+	return list(episodes)
+
+# With "db=<file>" before the command, the episode lists are kept in an
+# SQLite database (see episode_db.py) and diff, urlmap and fans_urlmap
+# are answered by joins instead of reading and splitting the text files.
+Episode_DB = None
+
+def open_db(spec, fans=False):
+	db = episode_db.EpisodeDB(Episode_DB)
+	if not db.count('wiki_episodes', spec.series):
+		db.close()
+		err('No {} wiki episodes in {}. Run the validator with db={} first.', spec.series, Episode_DB, Episode_DB)
+	if fans:
+		if not db.count('fans_episodes'):
+			db.close()
+			err('No tatort-fans.de episodes in {}. Run "fans_html2txt" with db={} first.', Episode_DB, Episode_DB)
+	elif os.path.exists(spec.html):
+		if db.changed(spec.html):
+			db.write_html_episodes(spec.series, read_html(spec), spec.html)
+	elif not db.count('html_episodes', spec.series):
+		db.close()
+		err('No daserste.de episodes for {} in {}', spec.series, Episode_DB)
+	return db
+
+def read_wiki_lines(spec):
 	title_map = {}
 	with InputFile(spec.title_map) as f:
 		for line in f:
@@ -305,19 +597,42 @@ def read_wiki(spec):
 	)
 	title_pattern = re.compile('[- !(),.0-9:?A-Za-zÄÜäöüßâàéô' + special_chars + ']+')
 
-	episodes = {}
 	with InputFile(spec.wiki_episodes) as f:
 		for line in f:
-			ep, date, title, url = line.rstrip().split('|')
-			unexpected_chars = title_pattern.sub('', title)
+			ep, date, wiki_title, url = line.rstrip().split('|')
+			unexpected_chars = title_pattern.sub('', wiki_title)
 			if unexpected_chars:
 				log('Unexpected characters [{}] in "{}"',
-					', '.join(['U+{:04X}'.format(ord(ch)) for ch in unexpected_chars]), title)
-			title = title_map.get(title, title.replace('\u2019', '\''))
-			episodes[int(ep)] = [date, title, url]
+					', '.join(['U+{:04X}'.format(ord(ch)) for ch in unexpected_chars]), wiki_title)
+			title = title_map.get(wiki_title, wiki_title.replace('\u2019', '\''))
+			yield int(ep), date, wiki_title, title, url
+
+def read_wiki(spec):
+	episodes = {}
+	for ep, date, wiki_title, title, url in read_wiki_lines(spec):
+		episodes[ep] = [date, title, url]
 	return episodes
 
+def urlmap_episode(ep, title, urls, wiki_title):
+	wiki_url = title2url(wiki_title) + '-'
+	last_url = None
+	for url in urls.split(','):
+		if not (len(url) > 3 and url[-3] in '12' and url[-2] in '0123456789' and url[-1] in '02468'):
+			log('{}|{}|Unexpected URL suffix: "{}"', ep, title, url)
+			continue
+		url = url[:-3]
+		if url != wiki_url and url != last_url:
+			yield url
+			last_url = url
+
 def urlmap(spec):
+	if Episode_DB:
+		with open_db(spec) as db:
+			for ep, title, urls, wiki_title in db.urlmap_rows(spec.series):
+				for url in urlmap_episode(ep, title, urls, wiki_title):
+					print(ep, url, sep='|')
+		return
+
 	wiki_titles = {}
 	with InputFile(spec.wiki_episodes) as f:
 		for line in f:
@@ -328,93 +643,440 @@ def urlmap(spec):
 		wiki_title = wiki_titles.get(ep)
 		if wiki_title is None:
 			continue
-		wiki_url = title2url(wiki_title) + '-'
-		last_url = None
-		for url in urls.split(','):
-			if not (len(url) > 3 and url[-3] in '12' and url[-2] in '0123456789' and url[-1] in '02468'):
-				log('{}|{}|Unexpected URL suffix: "{}"', ep, title, url)
-				continue
-			url = url[:-3]
-			if url != wiki_url and url != last_url:
-				print(ep, url, sep='|')
-				last_url = url
+		for url in urlmap_episode(ep, title, urls, wiki_title):
+			print(ep, url, sep='|')
 
 def html2txt(spec):
-	for info in read_html(spec):
+	episodes = read_html(spec)
+	for info in episodes:
 		print(*info, sep='|')
+	if Episode_DB:
+		with episode_db.EpisodeDB(Episode_DB) as db:
+			db.write_html_episodes(spec.series, episodes, spec.html)
 
 def fetch(spec):
-	command = ['/usr/bin/curl', '-o', spec.html, spec.url]
-
-	rc = subprocess.call(command)
-	if rc != 0:
-		err('Exit code', rc)
+	cache = IndexCache(spec)
+	try:
+		if not conditional_get(None, cache.validators, spec.html, spec.url):
+			log('{} is unchanged', spec.url)
+	except (OSError, urllib.error.URLError) as e:
+		err('Failed to fetch {}: {}', spec.url, e)
+	cache.save()
 
 	html2txt(spec)
 
+def stream(spec, args):
+	if len(args) > 1:
+		err('Too many command-line arguments!')
+	url = args[0] if args else spec.url
+	episodes = read_html(spec, open_url(url))
+	for info in episodes:
+		print(*info, sep='|')
+	if Episode_DB:
+		# Record the current state of the HTML file as the source so that
+		# open_db doesn't replace the streamed episodes with an older parse.
+		with episode_db.EpisodeDB(Episode_DB) as db:
+			db.write_html_episodes(spec.series, episodes, spec.html)
+
+def diff_episode(ep, info, wiki_info):
+	if not wiki_info:
+		yield (ep, 'ADD', *info)
+		return
+	if wiki_info == info:
+		return
+	date1, title1, url1 = info
+	date2, title2, url2 = wiki_info
+	if date1 != date2:
+		yield (ep, 'MOD-DATE', date2, date1)
+	if title1 != title2:
+		yield (ep, 'MOD-TITLE', title2, title1)
+	if not url2:
+		yield (ep, 'ADD-URL', url1)
+		return
+	urls1 = url1.split(',')
+	urls2 = url2.split(',')
+	url1_prefixes = [url[:-3] for url in urls1]
+	mod_url = True
+	for url in urls2:
+		if url in urls1:
+			mod_url = False
+		elif len(url) > 3 and url[:-3] in url1_prefixes:
+			mod_url = True
+			break
+	if mod_url:
+		yield (ep, 'MOD-URL', url2, url1)
+
 def diff(spec):
+	if Episode_DB:
+		with open_db(spec) as db:
+			for ep, date, title, urls, *wiki_info in db.diff_rows(spec.series, spec.title_map):
+				for row in diff_episode(ep, [date, title, urls], list(wiki_info) if wiki_info[0] else None):
+					print(*row, sep='|')
+		return
+
 	wiki_episodes = read_wiki(spec)
 
 	for ep, *info in read_html(spec):
-		wiki_info = wiki_episodes.get(ep)
-		if not wiki_info:
-			print(ep, 'ADD', *info, sep='|')
-			continue
-		if wiki_info == info:
-			continue
-		date1, title1, url1 = info
-		date2, title2, url2 = wiki_info
-		if date1 != date2:
-			print(ep, 'MOD-DATE', date2, date1, sep='|')
-		if title1 != title2:
-			print(ep, 'MOD-TITLE', title2, title1, sep='|')
-		if not url2:
-			print(ep, 'ADD-URL', url1, sep='|')
-			continue
-		urls1 = url1.split(',')
-		urls2 = url2.split(',')
-		url1_prefixes = [url[:-3] for url in urls1]
-		mod_url = True
-		for url in urls2:
-			if url in urls1:
-				mod_url = False
-			elif len(url) > 3 and url[:-3] in url1_prefixes:
-				mod_url = True
-				break
-		if mod_url:
-			print(ep, 'MOD-URL', url2, url1, sep='|')
+		for row in diff_episode(ep, info, wiki_episodes.get(ep)):
+			print(*row, sep='|')
+
+def ngrams(text, n=3):
+	text = '-' + title2url(text) + '-'
+	return {text[i:i+n] for i in range(len(text) - n + 1)}
+
+class NgramIndex(object):
+	# Maps each character trigram of the normalized (title2url) key to the
+	# entries containing it, so a lookup only scores entries that share at
+	# least one trigram with the query instead of every entry.
+	def __init__(self):
+		self.entries = []
+		self.grams = []
+		self.postings = {}
+
+	def add(self, key, entry):
+		i = len(self.entries)
+		grams = ngrams(key)
+		self.entries.append(entry)
+		self.grams.append(len(grams))
+		for gram in grams:
+			self.postings.setdefault(gram, []).append(i)
+
+	def best_match(self, key):
+		grams = ngrams(key)
+		shared = {}
+		for gram in grams:
+			for i in self.postings.get(gram, ()):
+				shared[i] = shared.get(i, 0) + 1
+		best_score, best = 0.0, None
+		for i, n in shared.items():
+			score = 2 * n / (len(grams) + self.grams[i])
+			if score > best_score:
+				best_score, best = score, self.entries[i]
+		return best_score, best
+
+def match(spec):
+	wiki_episodes = list(read_wiki_lines(spec))
+	html_episodes = read_html(spec)
+
+	html_titles = set()
+	html_urls = set()
+	title_index = NgramIndex()
+	url_index = NgramIndex()
+	for ep, date, title, urls in html_episodes:
+		html_titles.add(title)
+		title_index.add(title, title)
+		for url in urls.split(','):
+			if len(url) <= 3:
+				continue
+			url = url[:-3]
+			if url not in html_urls:
+				html_urls.add(url)
+				url_index.add(url, url)
+
+	folge_mapped = {ep for ep, url in read_url_map(spec.folge_url_map)} if spec.folge_url_map else set()
+
+	for ep, date, wiki_title, title, url in wiki_episodes:
+		if title not in html_titles:
+			score, html_title = title_index.best_match(title)
+			if html_title:
+				print('TITLE', '{:.2f}'.format(score), wiki_title, html_title, sep='|')
+		wiki_url = title2url(wiki_title) + '-'
+		if html_urls and wiki_url not in html_urls and ep not in folge_mapped:
+			score, html_url = url_index.best_match(wiki_url)
+			if html_url:
+				print('FOLGE-URL', '{:.2f}'.format(score), ep, html_url, sep='|')
+
+	if not spec.fans:
+		return
+
+	fans_urls = set()
+	fans_index = NgramIndex()
+	for ep, url in fans_read_html():
+		if url not in fans_urls:
+			fans_urls.add(url)
+			fans_index.add(url, url)
+
+	fans_mapped = {ep for ep, url in read_url_map(spec.fans_url_map)}
+
+	for ep, date, wiki_title, title, url in wiki_episodes:
+		wiki_url = title2url(wiki_title)
+		if fans_urls and wiki_url not in fans_urls and ep not in fans_mapped:
+			score, fans_url = fans_index.best_match(wiki_url)
+			if fans_url:
+				print('FANS-URL', '{:.2f}'.format(score), ep, fans_url, sep='|')
+
+WIKI, HTML, FANS, FOLGE_MAP, FANS_MAP, FUNDUS_MAP = range(6)
+
+def diff_url_map(ep, name, expected_urls, url_map):
+	for url in sorted(expected_urls - url_map):
+		yield (ep, 'ADD-' + name + '-MAP', url)
+	for url in sorted(url_map - expected_urls):
+		yield (ep, 'DEL-' + name + '-MAP', url)
+
+def reconcile_episode(spec, ep, sources):
+	# Like read_wiki, the last row for an episode wins.
+	wiki = sources[WIKI][-1] if sources[WIKI] else None
+	html = sources[HTML][-1] if sources[HTML] else None
+
+	if html:
+		yield from diff_episode(ep, list(html), wiki and [wiki[0], wiki[2], wiki[3]])
+	if not wiki:
+		for tag, name in ((FOLGE_MAP, 'FOLGE'), (FANS_MAP, 'FANS'), (FUNDUS_MAP, 'FUNDUS')):
+			yield from diff_url_map(ep, name, set(), set(sources[tag]))
+		return
+	date, wiki_title, title, url = wiki
+
+	if spec.folge_url_map:
+		expected_urls = set()
+		if html:
+			expected_urls.update(urlmap_episode(ep, html[1], html[2], wiki_title))
+		yield from diff_url_map(ep, 'FOLGE', expected_urls, set(sources[FOLGE_MAP]))
+
+	if spec.fans:
+		wiki_url = title2url(wiki_title)
+		expected_urls = {url for url in sources[FANS] if url != wiki_url}
+		yield from diff_url_map(ep, 'FANS', expected_urls, set(sources[FANS_MAP]))
+
+	if spec.fundus_url_map:
+		# There is no Tatort-Fundus index to compare with, so only entries
+		# that are no longer needed are reported.
+		wiki_url = title2url(wiki_title)
+		for url in sources[FUNDUS_MAP]:
+			if url == wiki_url:
+				yield (ep, 'DEL-FUNDUS-MAP', url)
+
+def reconcile(spec):
+	# All sources are sorted by episode number, so one merge pass groups
+	# everything known about an episode and each source is read once.
+	# The URL maps are edited by hand, so the order is checked.
+	def tagged(tag, name, rows):
+		prev_ep = None
+		for ep, value in rows:
+			if prev_ep is not None and ep < prev_ep:
+				err('{} is not sorted by episode number ({} after {})', name, ep, prev_ep)
+			prev_ep = ep
+			yield ep, tag, value
+
+	streams = [
+		tagged(WIKI, spec.wiki_episodes, ((ep, (date, wiki_title, title, url))
+			for ep, date, wiki_title, title, url in read_wiki_lines(spec))),
+		tagged(HTML, spec.html, ((ep, (date, title, urls)) for ep, date, title, urls in read_html(spec))),
+	]
+	if spec.fans:
+		streams.append(tagged(FANS, 'tatort-fans', fans_read_html()))
+	for tag, filename in ((FOLGE_MAP, spec.folge_url_map), (FANS_MAP, spec.fans_url_map),
+		(FUNDUS_MAP, spec.fundus_url_map)):
+		if filename:
+			streams.append(tagged(tag, filename, read_url_map(filename)))
+
+	merged = heapq.merge(*streams, key=lambda row: row[0])
+	for ep, rows in itertools.groupby(merged, key=lambda row: row[0]):
+		sources = [[] for tag in range(6)]
+		for ep, tag, value in rows:
+			sources[tag].append(value)
+		for row in reconcile_episode(spec, ep, sources):
+			print(*row, sep='|')
 
 def tatort_diff(): diff(TatortSpec)
+def tatort_reconcile(): reconcile(TatortSpec)
 def tatort_fetch(): fetch(TatortSpec)
 def tatort_html2txt(): html2txt(TatortSpec)
+def tatort_match(): match(TatortSpec)
+def tatort_stream(args): stream(TatortSpec, args)
 def tatort_urlmap(): urlmap(TatortSpec)
 
 def polizeiruf_diff(): diff(PolizeirufSpec)
+def polizeiruf_reconcile(): reconcile(PolizeirufSpec)
 def polizeiruf_fetch(): fetch(PolizeirufSpec)
 def polizeiruf_html2txt(): html2txt(PolizeirufSpec)
+def polizeiruf_match(): match(PolizeirufSpec)
+def polizeiruf_stream(args): stream(PolizeirufSpec, args)
 def polizeiruf_urlmap(): urlmap(PolizeirufSpec)
 
+Daemon_Socket = 'tatort.sock'
+Daemon_Interval = 3600
+Daemon_Request_Timeout = 10
+Daemon_Commands = (
+	'tatort_fetch',
+	'tatort_diff',
+	'tatort_urlmap',
+	'polizeiruf_fetch',
+	'polizeiruf_diff',
+)
+
+def run_command(args):
+	global Episode_DB
+	db = Episode_DB
+	if args and args[0].startswith('db='):
+		Episode_DB = args.pop(0)[3:]
+	try:
+		command = Commands.get(args.pop(0) if args else 'tatort_html2txt')
+		if not command:
+			err('Please specify a valid command.')
+		if command.__code__.co_argcount == 1:
+			command(args)
+		else:
+			command()
+	finally:
+		Episode_DB = db
+
+def run_captured(args):
+	# Runs a command inside the daemon. A command that calls err() or fails
+	# unexpectedly only fails itself, not the daemon.
+	stdout = io.StringIO()
+	stderr = io.StringIO()
+	status = 0
+	with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+		try:
+			if args and args[0] in ('daemon', 'client'):
+				err('The daemon cannot run "{}"', args[0])
+			run_command(list(args))
+		except SystemExit:
+			status = 1
+		except Exception:
+			traceback.print_exc()
+			status = 1
+	return status, stdout.getvalue(), stderr.getvalue()
+
+def run_scheduled(commands):
+	for command in commands:
+		start = time.monotonic()
+		status, stdout, stderr = run_captured([command])
+		for line in stderr.splitlines():
+			log('{}: {}', command, line)
+		if status:
+			log('{} failed, keeping the previous output', command)
+			continue
+		filename = command + '.txt'
+		with open(filename + '.tmp', 'w') as f:
+			f.write(stdout)
+		os.replace(filename + '.tmp', filename)
+		log('{} -> {} ({:.2f} s)', command, filename, time.monotonic() - start)
+
+def serve_request(conn):
+	# A client that doesn't send its command (or read the response) within
+	# the timeout is dropped, so that it can't hold up the daemon.
+	conn.settimeout(Daemon_Request_Timeout)
+	with conn, conn.makefile('rw', encoding='utf-8') as f:
+		try:
+			args = json.loads(f.readline())
+		except socket.timeout:
+			log('Timed out waiting for a command')
+			return
+		except ValueError:
+			return
+		start = time.monotonic()
+		status, stdout, stderr = run_captured(args)
+		log('{} ({:.2f} s)', ' '.join(args) or 'tatort_html2txt', time.monotonic() - start)
+		try:
+			f.write(json.dumps({'status': status, 'stdout': stdout, 'stderr': stderr}, ensure_ascii=False))
+			f.write('\n')
+			f.flush()
+		except OSError as e:
+			log('Failed to send the response: {}', e)
+
+def parse_daemon_args(args):
+	socket_path = Daemon_Socket
+	interval = Daemon_Interval
+	commands = []
+	for arg in args:
+		if arg.startswith('socket='):
+			socket_path = arg[7:]
+		elif arg.startswith('interval='):
+			try:
+				interval = int(arg[9:])
+			except ValueError:
+				err('The interval must be a number of seconds.')
+		elif arg in Commands and arg not in ('daemon', 'client'):
+			commands.append(arg)
+		else:
+			err('Invalid command-line argument "{}"', arg)
+	return socket_path, interval, commands or Daemon_Commands
+
+def daemon(args):
+	# Runs the given commands every interval seconds (never if the interval
+	# is 0), writing each command's output to <command>.txt, and any command
+	# sent by "tatort.py client" in between. Parsed indexes stay in memory
+	# between runs, so an unchanged index is neither hashed nor parsed again.
+	socket_path, interval, commands = parse_daemon_args(args)
+
+	if os.path.exists(socket_path):
+		# Only remove a stale socket, not the socket of a running daemon
+		with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+			try:
+				probe.connect(socket_path)
+			except ConnectionRefusedError:
+				os.remove(socket_path)
+			except OSError as e:
+				err('Failed to check {}: {}', socket_path, e)
+			else:
+				err('A daemon is already listening on {}', socket_path)
+	server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	server.bind(socket_path)
+	server.listen()
+	log('Listening on {}', socket_path)
+
+	next_run = time.monotonic() if interval > 0 else None
+	try:
+		while True:
+			if next_run is not None and time.monotonic() >= next_run:
+				run_scheduled(commands)
+				next_run = time.monotonic() + interval
+			server.settimeout(None if next_run is None else max(next_run - time.monotonic(), 0))
+			try:
+				conn, addr = server.accept()
+			except socket.timeout:
+				continue
+			serve_request(conn)
+	finally:
+		server.close()
+		os.remove(socket_path)
+
+def client(args):
+	socket_path = Daemon_Socket
+	if args and args[0].startswith('socket='):
+		socket_path = args.pop(0)[7:]
+
+	with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+		try:
+			conn.connect(socket_path)
+		except OSError as e:
+			err('Failed to connect to {}: {}', socket_path, e)
+		with conn.makefile('rw', encoding='utf-8') as f:
+			f.write(json.dumps(args, ensure_ascii=False))
+			f.write('\n')
+			f.flush()
+			response = json.loads(f.readline())
+
+	sys.stdout.write(response['stdout'])
+	sys.stderr.write(response['stderr'])
+	if response['status']:
+		sys.exit(response['status'])
+
+Commands = {
+	'client': client,
+	'daemon': daemon,
+	'fans_fetch': fans_fetch,
+	'fans_html2txt': fans_html2txt,
+	'fans_urlmap': fans_urlmap,
+	'tatort_diff': tatort_diff,
+	'tatort_fetch': tatort_fetch,
+	'tatort_html2txt': tatort_html2txt,
+	'tatort_match': tatort_match,
+	'tatort_reconcile': tatort_reconcile,
+	'tatort_stream': tatort_stream,
+	'tatort_urlmap': tatort_urlmap,
+	'polizeiruf_diff': polizeiruf_diff,
+	'polizeiruf_fetch': polizeiruf_fetch,
+	'polizeiruf_html2txt': polizeiruf_html2txt,
+	'polizeiruf_match': polizeiruf_match,
+	'polizeiruf_reconcile': polizeiruf_reconcile,
+	'polizeiruf_stream': polizeiruf_stream,
+	'polizeiruf_urlmap': polizeiruf_urlmap,
+}
+
 def main(args):
-	commands = {
-		'fans_fetch': fans_fetch,
-		'fans_html2txt': fans_html2txt,
-		'fans_urlmap': fans_urlmap,
-		'tatort_diff': tatort_diff,
-		'tatort_fetch': tatort_fetch,
-		'tatort_html2txt': tatort_html2txt,
-		'tatort_urlmap': tatort_urlmap,
-		'polizeiruf_diff': polizeiruf_diff,
-		'polizeiruf_fetch': polizeiruf_fetch,
-		'polizeiruf_html2txt': polizeiruf_html2txt,
-		'polizeiruf_urlmap': polizeiruf_urlmap,
-	}
-	command = commands.get(args.pop(0) if args else 'tatort_html2txt')
-	if not command:
-		err('Please specify a valid command.')
-	if command.__code__.co_argcount == 1:
-		command(args)
-	else:
-		command()
+	run_command(args)
 
 if __name__ == '__main__':
 	main(sys.argv[1:])
@@ -1,9 +1,221 @@
+import bisect
+import concurrent.futures
+import contextlib
+import episode_db
+import functools
+import hashlib
+import importlib.util
+import json
+import multiprocessing
+import os
+import pickle
 import pywikibot
 import re
 import sys
+import threading
+import time
+import tracemalloc
+import wiki_pages
+
+def err(message, *args):
+	print(message.format(*args), file=sys.stderr)
+	sys.exit()
+
+class PageResult(object):
+	def __init__(self):
+		self.info = None
+		self.log_lines = []
+		self.categories = []
+		self.templates = []
+		self.infobox_stats = Infobox_Stats()
+		self.profile = None
+
+class Profile(object):
+	# Wall time, number of calls and net allocated memory per phase. Time
+	# spent in a nested phase is charged to that phase only.
+
+	def __init__(self):
+		self.phases = {}
+		self.stack = []
+
+	def charge(self, name, since, now):
+		phase = self.phases.get(name)
+		if phase is None:
+			self.phases[name] = phase = [0, 0.0, 0]
+		phase[1] += now[0] - since[0]
+		phase[2] += now[1] - since[1]
+
+	def sample(self):
+		return time.perf_counter(), tracemalloc.get_traced_memory()[0]
+
+	def start(self, name):
+		now = self.sample()
+		if self.stack:
+			parent = self.stack[-1]
+			self.charge(parent[0], parent[1], now)
+		self.stack.append([name, now])
+		self.charge(name, now, now)
+		self.phases[name][0] += 1
+
+	def stop(self):
+		now = self.sample()
+		name, since = self.stack.pop()
+		self.charge(name, since, now)
+		if self.stack:
+			self.stack[-1][1] = now
+
+	def merge(self, phases):
+		for name, (calls, seconds, allocated) in phases.items():
+			phase = self.phases.get(name)
+			if phase is None:
+				self.phases[name] = phase = [0, 0.0, 0]
+			phase[0] += calls
+			phase[1] += seconds
+			phase[2] += allocated
+
+	def write(self, filename, total_seconds):
+		report = {
+			'total_seconds': round(total_seconds, 6),
+			'phases': {name: {
+				'calls': calls,
+				'seconds': round(seconds, 6),
+				'allocated_bytes': allocated,
+			} for name, (calls, seconds, allocated) in sorted(self.phases.items())},
+		}
+		with open(filename, 'w') as f:
+			json.dump(report, f, ensure_ascii=False, indent='\t')
+			print(file=f)
+
+Current_Profile = None
+Profile_File = None
+Profile_Start = None
+
+def start_profile(filename):
+	global Current_Profile, Profile_File, Profile_Start
+	if not filename:
+		return
+	tracemalloc.start()
+	Current_Profile = Profile()
+	Profile_File = filename
+	Profile_Start = time.perf_counter()
+
+def write_profile():
+	global Current_Profile
+	if Current_Profile is None:
+		return
+	Current_Profile.write(Profile_File, time.perf_counter() - Profile_Start)
+	Current_Profile = None
+	tracemalloc.stop()
+
+def start_phase(name):
+	if Current_Profile is not None:
+		Current_Profile.start(name)
+
+def stop_phase():
+	if Current_Profile is not None:
+		Current_Profile.stop()
+
+@contextlib.contextmanager
+def profile_phase(name):
+	start_phase(name)
+	try:
+		yield
+	finally:
+		stop_phase()
+
+def profile_iter(name, iterable):
+	iterator = iter(iterable)
+	while True:
+		with profile_phase(name):
+			try:
+				item = next(iterator)
+			except StopIteration:
+				return
+		yield item
+
+# While a page is being processed (possibly in a worker process), its
+# log lines and statistics are collected here instead of being written
+# right away, so that the main process can emit them in page order.
+Current_Result = None
+
+class DateRecorder(object):
+	# Stands in for the info object while a date string is parsed, so that
+	# the attributes that get set and the log lines that get written can be
+	# cached along with the result and replayed for the next info object.
+	def __init__(self):
+		object.__setattr__(self, 'value', '')
+		object.__setattr__(self, 'attrs', [])
+		object.__setattr__(self, 'log_args', [])
+
+	def __setattr__(self, name, value):
+		self.attrs.append((name, value))
+
+	def replay(self, info):
+		for name, value in self.attrs:
+			setattr(info, name, value)
+		for format_spec, args in self.log_args:
+			log(info, format_spec, *args)
+		return self.value
+
+	def finish(self, value):
+		object.__setattr__(self, 'value', value)
+		return self
+
+# Episode records and log lines go to stdout unless open_output()
+# directs them to separate (block-buffered) files. Log lines are written
+# either as LOG|page|message or as JSON objects with page, rule and args.
+Episode_File = None
+Log_File = None
+Episode_DB = None
+Episode_Rows = None
+Log_Format = 'text'
+Output_Buffer_Size = 1 << 16
+
+def open_output(params):
+	global Episode_File, Log_File, Log_Format
+	episodes = params.pop('episodes', None)
+	log = params.pop('log', None)
+	Log_Format = params.pop('logformat', 'text')
+	if episodes:
+		Episode_File = open(episodes, 'w', buffering=Output_Buffer_Size)
+	if log:
+		Log_File = open(log, 'w', buffering=Output_Buffer_Size)
+
+def close_output():
+	global Episode_File, Log_File
+	for f in (Episode_File, Log_File):
+		if f is not None:
+			f.close()
+	Episode_File = Log_File = None
+
+def flush_output():
+	for f in (Episode_File, Log_File, sys.stdout):
+		if f is not None:
+			f.flush()
+
+def write_episode(*fields):
+	print(*fields, sep='|', file=Episode_File)
+	if Episode_Rows is not None:
+		Episode_Rows.append([str(field) for field in fields])
+
+def write_log(line):
+	print(line, file=Log_File)
+
+def format_log(page_name, format_spec, args):
+	if Log_Format == 'jsonl':
+		return json.dumps({'page': page_name, 'rule': format_spec, 'args': args},
+			ensure_ascii=False, default=str)
+	return '|'.join(('LOG', page_name, format_spec.format(*args)))
 
 def log(info, format_spec, *args):
-	print('LOG', info.page_name, format_spec.format(*args), sep='|')
+	if isinstance(info, DateRecorder):
+		info.log_args.append((format_spec, args))
+		return
+	line = format_log(info.page_name, format_spec, args)
+	if Current_Result is None:
+		write_log(line)
+	else:
+		Current_Result.log_lines.append(line)
 
 def stringify(params):
 	return '|'.join(['='.join(p) for p in sorted(params.items())])
@@ -31,7 +243,6 @@ Month_Pattern = '(?: |&nbsp;)([A-Z][a-zä]{2,8}\\.?)'
 Year_Pattern = '([12][0-9]{3})'
 Date_Pattern = re.compile(f'{Day_Pattern}{Month_Pattern} +{Year_Pattern}')
 Before_Date_Pattern = re.compile(f'^{Day_Pattern}(?:{Month_Pattern})? +und +$')
-Special_Dates = {}
 
 def parse_date_before(info, param, extra, date, month, year):
 	if param == 'VG-DATUM':
@@ -59,39 +270,45 @@ def parse_date_before(info, param, extra, date, month, year):
 	setattr(info, attr, f'{year}-{month:02}-{day:02}')
 	return True
 
-def parse_date_after(info, param, extra):
-	if param == 'Sender':
-		return extra == ' ebd. (Teil 2)'
-	return False
+Date_Cache_Size = 4096
 
-def parse_date(info, param, date):
-	date = date.replace('\n', '\\n')
+@functools.lru_cache(maxsize=Date_Cache_Size)
+def normalize_date(series, param, date):
 	m = Date_Pattern.search(date)
 	if m is None:
-		special = Special_Dates.get((info.page_name, param))
-		if special:
-			if date == special[0]:
-				return special[1]
-		elif date in ('', EnDash) and param in ('VG-DATUM', 'NF-DATUM'):
-			return ''
-		log(info, 'Cannot parse date|{}={}|', param, date)
-		return ''
+		return None
 
+	info = DateRecorder()
 	day, month, year = m.groups()
 	day, month, year = int(day), Months.get(month, 0), int(year)
 
 	if month == 0 or day > Month_Days[month - 1]:
 		log(info, 'Invalid date|{}={}|', param, date)
-		return ''
+		return info
 
 	extra = date[:m.start()]
 	if extra and not parse_date_before(info, param, extra, date, month, year):
 		log(info, 'Extra text before date|{}={}|', param, date)
 	extra = date[m.end():]
-	if extra and not parse_date_after(info, param, extra):
+	if extra and not series.parse_date_after(info, param, extra):
 		log(info, 'Extra text after date|{}={}|', param, date)
 
-	return f'{year}-{month:02}-{day:02}'
+	return info.finish(f'{year}-{month:02}-{day:02}')
+
+def parse_date(info, param, date):
+	date = date.replace('\n', '\\n')
+	parsed = normalize_date(Current_Series, param, date)
+	if parsed is None:
+		special = Current_Series.special_dates.get((info.page_name, param))
+		if special:
+			if date == special[0]:
+				return special[1]
+		elif date in ('', EnDash) and param in ('VG-DATUM', 'NF-DATUM'):
+			return ''
+		log(info, 'Cannot parse date|{}={}|', param, date)
+		return ''
+
+	return parsed.replay(info)
 
 class Infobox_Stats(object):
 	Spec = (
@@ -128,77 +345,141 @@ class Infobox_Stats(object):
 
 	class Param(object):
 		Lookup = {}
-		def __init__(self, group):
-			self.num_used = 0
-			self.num_empty = 0
+		def __init__(self, index, name, group):
+			self.index = index
+			self.name = name
 			self.group = group
 			group.params.append(self)
 
 	class Group(object):
-		Lookup = {}
-		def __init__(self, names, flags):
-			self.num_used = 0
-			self.num_empty = 0
+		List = []
+		def __init__(self, index, names, flags):
+			self.index = index
+			self.bit = 1 << index
+			self.names = tuple(names)
 			self.must_use = 0
-			self.groups = None
+			self.counts_values = False
 			self.params = []
 
 			for flag in flags:
 				if   flag == '-': self.must_use = -1
 				elif flag == '+': self.must_use = 1
-				elif flag == 'g': self.groups = {}
+				elif flag == 'g': self.counts_values = True
 				else:
 					print('Unknown flag "{}" for "{}"'.format(flag, ', '.join(names)),
 						file=sys.stderr)
 
-		@classmethod
-		def clear_seen(self):
-			for group in self.Lookup.values():
-				group.seen = False
-
 	@classmethod
-	def init(self):
+	def init_spec(self):
 		params = self.Param.Lookup
-		groups = self.Group.Lookup
+		groups = self.Group.List
 
 		for names in self.Spec:
 			*names, flags = map(str.strip, names.split('|'))
 
-			groups[tuple(names)] = group = self.Group(names, flags)
+			group = self.Group(len(groups), names, flags)
+			groups.append(group)
 			for name in names:
-				params[name] = self.Param(group)
+				params[name] = self.Param(len(params), name, group)
+
+	# An instance holds the counts for one page, one run, or the merged
+	# counts of several shards. Parameters and groups are numbered by the
+	# spec, and the values of 'g' groups are interned per instance.
+
+	def __init__(self):
+		num_params = len(self.Param.Lookup)
+		self.num_used = [0] * num_params
+		self.num_empty = [0] * num_params
+		self.values = []
+		self.value_ids = {}
+		self.value_counts = [{} if group.counts_values else None for group in self.Group.List]
+
+	def intern(self, value):
+		value_id = self.value_ids.get(value)
+		if value_id is None:
+			self.value_ids[value] = value_id = len(self.values)
+			self.values.append(value)
+		return value_id
+
+	def count_value(self, group, value, num=1):
+		counts = self.value_counts[group.index]
+		value_id = self.intern(value)
+		counts[value_id] = counts.get(value_id, 0) + num
+
+	def count(self, param, used, group_value):
+		if used:
+			self.num_used[param.index] += 1
+		else:
+			self.num_empty[param.index] += 1
+		if group_value is not None:
+			self.count_value(param.group, group_value)
+
+	def merge(self, other):
+		for i, num in enumerate(other.num_used):
+			self.num_used[i] += num
+		for i, num in enumerate(other.num_empty):
+			self.num_empty[i] += num
+		for group in self.Group.List:
+			counts = other.value_counts[group.index]
+			if counts:
+				for value_id, num in counts.items():
+					self.count_value(group, other.values[value_id], num)
+
+	def dump(self):
+		return {
+			'params': {param.name: [self.num_used[param.index], self.num_empty[param.index]]
+				for param in self.Param.Lookup.values()
+				if self.num_used[param.index] or self.num_empty[param.index]},
+			'values': {', '.join(group.names): {self.values[value_id]: num
+				for value_id, num in self.value_counts[group.index].items()}
+				for group in self.Group.List if self.value_counts[group.index]},
+		}
 
 	@classmethod
+	def load(self, data):
+		stats = self()
+		for name, (num_used, num_empty) in data['params'].items():
+			param = self.Param.Lookup[name]
+			stats.num_used[param.index] = num_used
+			stats.num_empty[param.index] = num_empty
+		groups = {', '.join(group.names): group for group in self.Group.List}
+		for names, counts in data['values'].items():
+			group = groups[names]
+			for value, num in counts.items():
+				stats.count_value(group, value, num)
+		return stats
+
 	def write_params(self, f, attr):
 		print('------+', attr, 'Infobox Parameters ----', file=f)
-		attr = 'num_' + attr.lower()
-		for names, group in sorted(self.Group.Lookup.items()):
-			num = getattr(group, attr)
+		counts = getattr(self, 'num_' + attr.lower())
+		for group in sorted(self.Group.List, key=lambda group: group.names):
+			num = sum(counts[param.index] for param in group.params)
 			if num == 0: continue
-			print(' {:4} |'.format(num), ', '.join(['{} ({})'.format(name, getattr(param, attr))
-				for name, param in zip(names, group.params)]), file=f)
+			print(' {:4} |'.format(num), ', '.join(['{} ({})'.format(param.name, counts[param.index])
+				for param in group.params]), file=f)
 
-	@classmethod
 	def write_groups(self, f):
-		for names, group in sorted(self.Group.Lookup.items()):
-			groups = group.groups
-			if groups is None: continue
-			print('------+', ', '.join(names), '----', file=f)
-			for value, num in sorted(groups.items()):
+		for group in sorted(self.Group.List, key=lambda group: group.names):
+			counts = self.value_counts[group.index]
+			if counts is None: continue
+			print('------+', ', '.join(group.names), '----', file=f)
+			for value, num in sorted((self.values[value_id], num) for value_id, num in counts.items()):
 				print(' {:4} |'.format(num), value, file=f)
 
-	@classmethod
 	def write(self, filename):
 		with open(filename, 'w') as f:
 			self.write_params(f, 'Used')
 			self.write_params(f, 'Empty')
 			self.write_groups(f)
 
+Infobox_Stats.init_spec()
+
 Ref_Pattern = re.compile('<ref(?:(?:>[^<>]+</ref>)|(?: +name *= *"[- 0-9A-Z_a-z]+" */>))')
 
 def update_infobox_stats(info, params):
-	Infobox_Stats.Group.clear_seen()
+	stats = Current_Result.infobox_stats
 	param_lookup = Infobox_Stats.Param.Lookup
+	seen = 0
 
 	for name, value in params.items():
 		param = param_lookup.get(name)
@@ -207,23 +488,19 @@ def update_infobox_stats(info, params):
 			continue
 		group = param.group
 		if value:
-			param.num_used += 1
-			group.num_used += 1
 			if group.must_use < 0:
 				log(info, 'Infobox parameter {} should be empty', name)
 		else:
-			param.num_empty += 1
-			group.num_empty += 1
 			if group.must_use > 0:
 				log(info, 'Infobox parameter {} should not be empty', name)
-		groups = group.groups
-		if groups is not None:
-			value = Ref_Pattern.sub('', value).replace('\n', '\\n')
-			groups[value] = groups.get(value, 0) + 1
-		if group.seen:
+		group_value = None
+		if group.counts_values:
+			group_value = Ref_Pattern.sub('', value).replace('\n', '\\n')
+		stats.count(param, bool(value), group_value)
+		if seen & group.bit:
 			log(info, 'Should specify only one Infobox parameter {}', name)
 		else:
-			group.seen = True
+			seen |= group.bit
 
 def check_infobox_common(info, params):
 	for p in (
@@ -240,11 +517,8 @@ def check_infobox_common(info, params):
 		if p not in params:
 			log(info, 'Missing Infobox parameter {}', p)
 
-Infobox_Series_Params = [
-	('Reihe', True, 'ja'),
-]
-def check_infobox_normal(info, params, series_params=Infobox_Series_Params):
-	for p, required, x in series_params:
+def check_infobox_normal(info, params, series_params=None):
+	for p, required, x in series_params or Current_Series.infobox_params:
 		v = params.get(p)
 		if v is None:
 			if required:
@@ -264,16 +538,13 @@ def check_infobox_special(info, params):
 		if p in params:
 			log(info, 'Unexpected Infobox parameter {}', p)
 
-Series = 'Tatort'
-Series_Prefix = Series + ': '
-Alternate_Infobox_Dates = {}
-Alternate_Titles = {}
 Episode_Number_Pattern = re.compile('^[1-9][0-9]*')
 PageName_Suffix_Pattern = re.compile('^ \\((?:[12][0-9]{3}|Film)\\)$')
 
 def get_episode_name(name):
-	if name.startswith(Series_Prefix):
-		name = name[len(Series_Prefix):]
+	prefix = Current_Series.prefix
+	if name.startswith(prefix):
+		name = name[len(prefix):]
 	if name.endswith(')'):
 		i = name.find('(')
 		if i > 1 and PageName_Suffix_Pattern.match(name[i-1:]):
@@ -293,9 +564,9 @@ def check_title(info, template, title, part=None):
 			return
 	if title == info.episode_name:
 		return
-	if title == Alternate_Titles.get(info.page_name):
+	if title == Current_Series.alternate_titles.get(info.page_name):
 		return
-	if title == Series_Prefix + info.episode_name:
+	if title == Current_Series.prefix + info.episode_name:
 		return
 	log(info, 'Mismatched {} title|{}|', template, title)
 
@@ -379,7 +650,7 @@ def get_infobox_date(info, params):
 		v = parse_date(info, p, v)
 		if not v:
 			continue
-		alt = Alternate_Infobox_Dates.get(info.page_name)
+		alt = Current_Series.alternate_infobox_dates.get(info.page_name)
 		if alt:
 			if v == alt[0]:
 				v = alt[1]
@@ -414,7 +685,7 @@ def do_infobox_episode(info, params):
 
 	if info.infobox_title == 'Unter Brüdern':
 		check_infobox_special(info, params)
-		set_episode_number(info, '235' if Series == 'Tatort' else '142')
+		set_episode_number(info, '235' if Current_Series.name == 'Tatort' else '142')
 	else:
 		check_infobox_normal(info, params)
 		set_episode_number(info, params.get('Episode', ''))
@@ -438,61 +709,277 @@ def check_attrs(info, attr, prev):
 		check_attr(info, attr + '_ep_date', prev.infobox_date)
 		check_attr(info, attr + '_ep_date2', '')
 	name = prev.page_name
-	link = getattr(info, attr + '_ep_page') or Series_Prefix + getattr(info, attr + '_episode')
+	link = getattr(info, attr + '_ep_page') or Current_Series.prefix + getattr(info, attr + '_episode')
 	if link != name and link != name.replace(' ', '_'):
 		log(info, 'Mismatched {}_ep_page|{}|{}|', attr, link, name)
 
-def process_pages(info_class, process_page, *other_actions):
-	categories = {}
-	templates = {}
-	Infobox_Stats.init()
-	info_list = []
+class SeriesConfig(object):
+	# Everything that differs between the series. A series script defines
+	# a subclass and passes an instance of it to run_series (or to
+	# process_pages, check_sequence and watch_pages), which make it the
+	# Current_Series while the series' pages are checked.
+
+	name = None
+	info_class = None
+	template_actions = ()
+	special_dates = {}
+	alternate_infobox_dates = {}
+	alternate_titles = {}
+	infobox_params = (
+		('Reihe', True, 'ja'),
+	)
+	# Files whose content the stored results depend on, besides this
+	# module and the series script (e.g. the URL maps used by check_page).
+	store_inputs = ()
+	first_sortkey = 1
+	no_episode = ''
 
-	navbar = 'Folgenleiste {}-Folgen'.format(Series.replace(' ', '-'))
-	template_actions = {
-		navbar: do_folgenleiste,
-		'IMDb': do_imdb,
-		'Infobox Episode': do_infobox_episode,
-	}
-	template_actions.update(other_actions)
+	def __init__(self):
+		self.prefix = self.name + ': '
+		self.navbar = 'Folgenleiste {}-Folgen'.format(self.name.replace(' ', '-'))
+		self.file_name = self.name.replace(' ', '').lower()
 
-	Namespace = pywikibot.site.Namespace
-	main_ns = Namespace.MAIN
+	def setup(self):
+		pass
 
-	site = pywikibot.Site(code='de')
-	pages = pywikibot.Page(site, navbar, ns=Namespace.TEMPLATE).getReferences(
-		only_template_inclusion=True, namespaces=(main_ns,))
+	# What setup() loaded, for the worker processes (see map_pages).
 
-	for page in pages:
-		info = info_class(page.title())
+	def worker_state(self):
+		return None
 
-		ns = page.namespace()
-		if ns.id != main_ns:
-			log(info, 'Not in the main namespace|{}|', ns.canonical_name)
-			continue
+	def load_worker_state(self, state):
+		pass
 
-		for cat in page.categories():
-			name = cat.title()
-			categories[name] = categories.get(name, 0) + 1
+	def check_page(self, info, page):
+		pass
 
-		for name, params in page.raw_extracted_templates:
+	def parse_date_after(self, info, param, extra):
+		if param == 'Sender':
+			return extra == ' ebd. (Teil 2)'
+		return False
+
+	# The cross-episode checks compare each episode with the one before it.
+
+	def next_sortkey(self, info):
+		return info.sortkey + (2 if info.double_episode else 1)
+
+	def ep2str(self, ep):
+		return str(ep)
+
+	def check_pair(self, prev, info):
+		check_attrs(info, 'prev', prev)
+		check_attrs(prev, 'next', info)
+
+	def write_episodes(self, info):
+		write_episode(info.episode_number, info.infobox_date, info.episode_name)
+
+Current_Series = None
+
+@contextlib.contextmanager
+def current_series(series):
+	global Current_Series
+	previous = Current_Series
+	Current_Series = series
+	try:
+		yield
+	finally:
+		Current_Series = previous
+
+def check_episode(prev, info):
+	series = Current_Series
+	expected = series.first_sortkey if prev is None else series.next_sortkey(prev)
+	if info.sortkey != expected:
+		log(info, 'Unexpected episode number|{}|{}', series.ep2str(info.sortkey), series.ep2str(expected))
+	elif prev:
+		series.check_pair(prev, info)
+	else:
+		check_attr(info, 'prev_episode', series.no_episode)
+		check_attr(info, 'prev_ep_date', '')
+
+def check_last(info):
+	check_attr(info, 'next_episode', Current_Series.no_episode)
+	check_attr(info, 'next_ep_date', '')
+
+def check_sequence(series, info_list):
+	# With db=, the episode records are also written to the episode database
+	# (replacing the series' previous records in one transaction).
+	global Episode_Rows
+	if Episode_DB is not None:
+		Episode_Rows = []
+	with profile_phase('cross-episode checks'), current_series(series):
+		prev = None
+		for info in info_list:
+			if Page_Store is None:
+				check_episode(prev, info)
+			else:
+				Page_Store.check_episode(prev, info)
+			series.write_episodes(info)
+			prev = info
+		if prev:
+			if Page_Store is None:
+				check_last(prev)
+			else:
+				Page_Store.check_last(prev)
+	if Page_Store is not None:
+		Page_Store.save()
+	if Episode_Rows is not None:
+		Episode_DB.write_wiki_episodes(series.file_name, Episode_Rows)
+		Episode_Rows = None
+
+def parse_jobs(value):
+	value = int(value)
+	if value < 1:
+		raise ValueError('must be >= 1')
+	return value
+
+def parse_interval(value):
+	value = float(value)
+	if value <= 0:
+		raise ValueError('must be > 0')
+	return value
+
+def parse_log_format(value):
+	if value not in ('text', 'jsonl'):
+		raise ValueError('must be text or jsonl')
+	return value
+
+Valid_Params = {
+	'cache': str,
+	'episodes': str,
+	'interval': parse_interval,
+	'jobs': parse_jobs,
+	'log': str,
+	'db': str,
+	'logformat': parse_log_format,
+	'metrics': str,
+	'profile': str,
+	'record': str,
+	'snapshot': str,
+	'store': str,
+	'watch': str,
+}
+
+def parse_args(args, valid_params=Valid_Params):
+	params = {}
+	for arg in args:
+		param, sep, value = arg.partition('=')
+		parse = valid_params.get(param)
+		if not (sep and parse):
+			err('Invalid command-line argument "{}"', arg)
+		try:
+			params[param] = parse(value)
+		except ValueError:
+			err('Invalid value for command-line parameter "{}"', param)
+	return params
+
+Current_Metrics = None
+
+def start_metrics(filename):
+	global Current_Metrics
+	if not filename:
+		return
+	Current_Metrics = wiki_pages.Metrics(os.path.splitext(os.path.basename(sys.argv[0]))[0], filename)
+	Current_Metrics.start()
+
+def stop_metrics():
+	global Current_Metrics
+	if Current_Metrics is None:
+		return
+	Current_Metrics.stop()
+	Current_Metrics = None
+
+def site_request():
+	request = wiki_pages.site_request(pywikibot.Site(code='de'))
+	if Current_Metrics is not None:
+		request = wiki_pages.metered_request(request, Current_Metrics)
+	return request
+
+def get_pages(navbar, request=None, cache=None, record=None, snapshot=None, profile=True):
+	wrap = profile_iter if profile else lambda name, iterable: iterable
+
+	if snapshot:
+		return wrap('load pages', wiki_pages.read_snapshot(snapshot))
+
+	main_ns = pywikibot.site.Namespace.MAIN
+	if request is None:
+		request = site_request()
+	references = wiki_pages.references(request, 'Template:' + navbar, main_ns)
+	references = wrap('references', references)
+	if Current_Metrics is not None:
+		references = list(references)
+		Current_Metrics.add_total(len(references))
+	if cache:
+		pages = wiki_pages.PageCache(cache).load_pages(request, references, Current_Metrics)
+	else:
+		pages = wiki_pages.load_pages(request, [title for title, revid in references])
+	if record:
+		pages = wiki_pages.record_snapshot(pages, record)
+	return wrap('load pages', pages)
+
+Builtin_Namespaces = pywikibot.site.Namespace.builtin_namespaces()
+
+def namespace_name(ns):
+	# The site's namespace map is only needed (and fetched) for namespaces
+	# that aren't built into MediaWiki, like "Portal".
+	namespace = Builtin_Namespaces.get(ns)
+	if namespace is None:
+		namespace = pywikibot.Site(code='de').namespaces[ns]
+	return namespace.canonical_name
+
+class PageProcessor(object):
+	def __init__(self, info_class, process_page, template_actions):
+		self.info_class = info_class
+		self.process_page = process_page
+		self.template_actions = template_actions
+
+	def __call__(self, page):
+		# Each page gets its own profile so that the phases measured in a
+		# worker process can be merged into the main process's profile.
+		global Current_Result, Current_Profile
+		Current_Result = result = PageResult()
+		main_profile = Current_Profile
+		if main_profile is not None:
+			Current_Profile = Profile()
+		try:
+			result.info = self.process(page, result)
+		finally:
+			Current_Result = None
+			if main_profile is not None:
+				result.profile = Current_Profile.phases
+				Current_Profile = main_profile
+		return result
+
+	def process(self, page, result):
+		info = self.info_class(page.title)
+
+		if page.ns != pywikibot.site.Namespace.MAIN:
+			log(info, 'Not in the main namespace|{}|', namespace_name(page.ns))
+			return None
+
+		result.categories = page.categories
+
+		with profile_phase('template extraction'):
+			extracted_templates = page.raw_extracted_templates
+
+		for name, params in extracted_templates:
 			if name.startswith(('SORTIERUNG:', 'DEFAULTSORT:')):
 				continue
-			action = template_actions.get(name)
+			action = self.template_actions.get(name)
 			if action:
-				action(info, params)
-			templates[name] = templates.get(name, 0) + 1
+				with profile_phase('action: ' + name):
+					action(info, params)
+			result.templates.append(name)
 
 		ep = info.episode_number
 		if ep is None:
-			log(info, 'Missing {} Infobox', Series)
-			continue
+			log(info, 'Missing {} Infobox', Current_Series.name)
+			return None
 		if not ep:
 			log(info, 'Missing episode number')
-			continue
+			return None
 		if not info.sortkey:
 			log(info, 'Invalid episode number|{}|', ep)
-			continue
+			return None
 
 		if info.infobox_title:
 			check_title(info, 'Infobox', info.infobox_title)
@@ -500,28 +987,427 @@ def process_pages(info_class, process_page, *other_actions):
 			log(info, 'Missing episode title')
 		if not info.infobox_date:
 			log(info, 'Missing episode date')
-			continue
+			return None
 		if info.prev_episode is None:
 			log(info, 'Missing Folgenleiste')
-			continue
+			return None
 
 		if info.imdb is None:
 			log(info, 'Missing IMDb')
 
-		process_page(info, page)
-		info_list.append(info)
+		with profile_phase('check page'):
+			self.process_page(info, page)
+		return info
+
+Chunk_Size = 8
+
+def worker_start_method():
+	# The platform's default, except that a process running other threads
+	# (the page loaders of other series, the metrics reporter) isn't forked,
+	# since a child could inherit a lock held by one of them.
+	method = multiprocessing.get_start_method()
+	if method == 'fork' and threading.active_count() > 1:
+		method = 'forkserver'
+	return method
+
+def load_module(module_name, path):
+	# Loads a series script by path and registers it as a module, so that
+	# its classes can be pickled for (and unpickled by) worker processes.
+	spec = importlib.util.spec_from_file_location(module_name, path)
+	sys.modules[module_name] = module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
+
+def init_worker(module_name, module_file, state):
+	# Runs in each worker process. The series script may have been loaded by
+	# path (series-wiki.py, bench-wiki.py), in which case it's loaded the
+	# same way here, before the series object and its state are unpickled.
+	global Current_Series, Current_Profile, Log_Format
+	if module_name not in sys.modules:
+		load_module(module_name, module_file)
+	series, series_state, Log_Format, profile = pickle.loads(state)
+	series.load_worker_state(series_state)
+	Current_Series = series
+	if profile:
+		tracemalloc.start()
+		Current_Profile = Profile()
+
+def map_pages(processor, pages, jobs):
+	if jobs > 1:
+		series = Current_Series
+		module = sys.modules[type(series).__module__]
+		state = pickle.dumps((series, series.worker_state(), Log_Format, Current_Profile is not None))
+		context = multiprocessing.get_context(worker_start_method())
+		if context.get_start_method() == 'forkserver':
+			# The fork server imports this module (and pywikibot) only once.
+			context.set_forkserver_preload([__name__])
+		with context.Pool(jobs, init_worker, (module.__name__, module.__file__, state)) as pool:
+			yield from pool.imap(processor, pages, Chunk_Size)
+	else:
+		yield from map(processor, pages)
+
+def sort_order(info):
+	# Pages with the same episode number are ordered by name, so that the
+	# order does not depend on the order in which the pages were loaded.
+	return info.sortkey, info.page_name
+
+def page_processor(series):
+	template_actions = {
+		series.navbar: do_folgenleiste,
+		'IMDb': do_imdb,
+		'Infobox Episode': do_infobox_episode,
+	}
+	template_actions.update(series.template_actions)
+	return PageProcessor(series.info_class, series.check_page, template_actions)
+
+def store_key(series):
+	key = hashlib.sha256(Log_Format.encode())
+	# The module and name of the info class are part of the pickled results.
+	info_class = series.info_class
+	key.update('{}.{}'.format(info_class.__module__, info_class.__qualname__).encode())
+	for filename in (__file__, sys.modules[type(series).__module__].__file__, *series.store_inputs):
+		with open(filename, 'rb') as f:
+			key.update(f.read())
+	return key.hexdigest()
+
+def collect_log(check, *args):
+	global Current_Result
+	Current_Result = result = PageResult()
+	try:
+		check(*args)
+	finally:
+		Current_Result = None
+	return result.log_lines
+
+class PageStore(object):
+	# The per-page results of the last run, keyed by title and revision,
+	# and the log lines of each episode's check against its predecessor.
+	# Only pages whose revision changed are processed again, and only the
+	# cross-episode checks involving such a page (or a new neighbour) are
+	# repeated. The rest of the output is replayed from the store.
+
+	def __init__(self, filename, key):
+		self.filename = filename
+		self.key = key
+		self.pages = {}
+		self.pairs = {}
+		self.last = None
+		self.changed = set()
+		self.new_pairs = {}
+		self.new_last = None
+		if os.path.exists(filename):
+			self.load()
+
+	def load(self):
+		# The key is a record of its own, so that a store written by another
+		# version (or another script, since the pickled info objects name the
+		# module of their class) is discarded without unpickling its pages.
+		try:
+			with open(self.filename, 'rb') as f:
+				if pickle.load(f) != self.key:
+					return
+				store = pickle.load(f)
+		except (pickle.UnpicklingError, AttributeError, ImportError, EOFError, ValueError) as e:
+			print('Discarding {}: {}'.format(self.filename, e), file=sys.stderr)
+			return
+		self.pages = store['pages']
+		self.pairs = store['pairs']
+		self.last = store['last']
+
+	def save(self):
+		for revid, result in self.pages.values():
+			result.profile = None
+		store = {
+			'pages': self.pages,
+			'pairs': self.new_pairs,
+			'last': self.new_last,
+		}
+		temp_filename = self.filename + '.tmp'
+		with open(temp_filename, 'wb') as f:
+			pickle.dump(self.key, f, pickle.HIGHEST_PROTOCOL)
+			pickle.dump(store, f, pickle.HIGHEST_PROTOCOL)
+		os.replace(temp_filename, self.filename)
+
+	def results(self, processor, pages, jobs):
+		pages = list(pages)
+		stored = []
+		for page in pages:
+			entry = self.pages.get(page.title)
+			stored.append(entry[1] if entry and page.revid is not None and entry[0] == page.revid else None)
+
+		results = map_pages(processor, [page for page, result in zip(pages, stored) if result is None], jobs)
+		self.pages = {}
+		for page, result in zip(pages, stored):
+			if result is None:
+				result = next(results)
+				self.changed.add(page.title)
+			self.pages[page.title] = (page.revid, result)
+			yield result
+
+	def unchanged(self, *infos):
+		return not any(info.page_name in self.changed for info in infos if info)
+
+	def check_episode(self, prev, info):
+		prev_name = prev.page_name if prev else None
+		entry = self.pairs.get(info.page_name)
+		if entry and entry[0] == prev_name and self.unchanged(prev, info):
+			lines = entry[1]
+		else:
+			lines = collect_log(check_episode, prev, info)
+		for line in lines:
+			write_log(line)
+		self.new_pairs[info.page_name] = (prev_name, lines)
+
+	def check_last(self, info):
+		if self.last and self.last[0] == info.page_name and self.unchanged(info):
+			lines = self.last[1]
+		else:
+			lines = collect_log(check_last, info)
+		for line in lines:
+			write_log(line)
+		self.new_last = (info.page_name, lines)
+
+Page_Store = None
+
+def process_pages(series, pages, jobs=1, store=None):
+	global Page_Store
+	categories = {}
+	templates = {}
+	infobox_stats = Infobox_Stats()
+	info_list = []
 
-	series = Series.replace(' ', '').lower()
+	processor = page_processor(series)
 
-	with open(series + '-categories.txt', 'w') as f:
+	if store:
+		Page_Store = PageStore(store, store_key(series))
+		results = Page_Store.results(processor, pages, jobs)
+	else:
+		Page_Store = None
+		results = map_pages(processor, pages, jobs)
+
+	# The pages are processed (by map_pages) as the results are consumed.
+	with current_series(series):
+		for result in results:
+			if Current_Metrics is not None:
+				Current_Metrics.add_pages()
+			for line in result.log_lines:
+				write_log(line)
+			for name in result.categories:
+				categories[name] = categories.get(name, 0) + 1
+			for name in result.templates:
+				templates[name] = templates.get(name, 0) + 1
+			infobox_stats.merge(result.infobox_stats)
+			if result.info:
+				info_list.append(result.info)
+			if result.profile:
+				Current_Profile.merge(result.profile)
+
+	start_phase('write files')
+
+	with open(series.file_name + '-categories.txt', 'w') as f:
 		for name, count in sorted(categories.items()):
 			print('{:5}'.format(count), name, sep=' | ', file=f)
 
-	with open(series + '-templates.txt', 'w') as f:
+	with open(series.file_name + '-templates.txt', 'w') as f:
 		for name, count in sorted(templates.items()):
 			print('{:5}'.format(count), name, sep=' | ', file=f)
 
-	Infobox_Stats.write(series + '-infobox-stats.txt')
+	infobox_stats.write(series.file_name + '-infobox-stats.txt')
+	stop_phase()
 
-	info_list.sort(key=lambda info: info.sortkey)
+	info_list.sort(key=sort_order)
 	return info_list
+
+Watch_Interval = 10
+
+class RecentChanges(object):
+	# Polls the recent changes of the main namespace for edits of the pages
+	# that use the navigation bar, and for new pages (which are loaded only
+	# if they use it).
+	def __init__(self, series, request):
+		self.request = request
+		self.template = 'Template:' + series.navbar
+		self.start = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+		self.seen = set()
+		self.titles = {title for title, revid in wiki_pages.references(self.request, self.template)}
+
+	def poll(self):
+		titles = []
+		new_titles = []
+		for title, revid, timestamp, change_type in wiki_pages.recent_changes(self.request, self.start):
+			# rcstart is inclusive, so the changes at the last timestamp come again.
+			if revid in self.seen:
+				continue
+			if timestamp != self.start:
+				self.start = timestamp
+				self.seen = set()
+			self.seen.add(revid)
+			if title in self.titles:
+				if title not in titles:
+					titles.append(title)
+			elif change_type == 'new' and title not in new_titles:
+				new_titles.append(title)
+		if new_titles:
+			navbar_titles = set(wiki_pages.transcluding(self.request, new_titles, self.template))
+			for title in new_titles:
+				if title in navbar_titles:
+					self.titles.add(title)
+					titles.append(title)
+		return list(wiki_pages.load_pages(self.request, titles))
+
+class SnapshotChanges(object):
+	# A local stand-in for the recent changes: the pages (in the format
+	# written by record=) that get appended to a file after watching began.
+	def __init__(self, filename):
+		self.file = open(filename, 'a+')
+		self.file.seek(0, os.SEEK_END)
+		self.partial = ''
+
+	def poll(self):
+		pages = []
+		while line := self.file.readline():
+			line = self.partial + line
+			if not line.endswith('\n'):
+				self.partial = line
+				break
+			self.partial = ''
+			pages.append(wiki_pages.WikiPage.from_json(line))
+		return pages
+
+def open_watch(watch, series, request):
+	if watch == 'rc':
+		return RecentChanges(series, request or site_request())
+	return SnapshotChanges(watch)
+
+def revalidate(processor, navbar, info_list, sortkeys, page, recheck):
+	# Runs the per-page checks for an edited page, moves its info object to
+	# where its (possibly changed) sortkey belongs, and notes the episodes
+	# whose check against their predecessor has to be repeated. Like in the
+	# full run, only pages that use the navigation bar are logged.
+	result = processor(page)
+	uses_navbar = navbar in result.templates
+	if uses_navbar:
+		for line in result.log_lines:
+			write_log(line)
+
+	for i, info in enumerate(info_list):
+		if info.page_name == page.title:
+			del info_list[i]
+			del sortkeys[i]
+			if i < len(info_list):
+				recheck.append(info_list[i])
+			elif info_list:
+				recheck.append(info_list[-1])
+			break
+
+	info = result.info
+	if info and uses_navbar:
+		key = sort_order(info)
+		i = bisect.bisect_left(sortkeys, key)
+		info_list.insert(i, info)
+		sortkeys.insert(i, key)
+		recheck.append(info)
+		if i + 1 < len(info_list):
+			recheck.append(info_list[i + 1])
+
+def watch_pages(changes, info_list, series, interval=Watch_Interval):
+	# After the full run, only the edited pages are checked again, plus the
+	# checks between each of them and its previous and next episode.
+	navbar = series.navbar
+	processor = page_processor(series)
+	sortkeys = [sort_order(info) for info in info_list]
+	flush_output()
+	try:
+		with current_series(series):
+			watch_changes(changes, info_list, processor, navbar, sortkeys, interval)
+	except KeyboardInterrupt:
+		pass
+
+def watch_changes(changes, info_list, processor, navbar, sortkeys, interval):
+	while True:
+		pages = changes.poll()
+		recheck = []
+		for page in pages:
+			revalidate(processor, navbar, info_list, sortkeys, page, recheck)
+		if recheck:
+			positions = {id(info): i for i, info in enumerate(info_list)}
+			for i in sorted({positions[id(info)] for info in recheck if id(info) in positions}):
+				check_episode(info_list[i-1] if i else None, info_list[i])
+				if i == len(info_list) - 1:
+					check_last(info_list[i])
+		if pages:
+			flush_output()
+			print('Checked {} edited page(s)'.format(len(pages)), file=sys.stderr)
+		time.sleep(interval)
+
+# File parameters that each series needs its own value for. With several
+# series, "{series}" in the value is replaced by the series' file name.
+Series_File_Params = ('cache', 'episodes', 'log', 'record', 'snapshot', 'store')
+Load_Params = ('cache', 'record', 'snapshot')
+
+def series_params(series, params, multiple):
+	params = dict(params)
+	for param in Series_File_Params:
+		value = params.get(param)
+		if value is None:
+			continue
+		if multiple and '{series}' not in value:
+			err('The value of {} must contain {{series}} when checking more than one series', param)
+		params[param] = value.replace('{series}', series.file_name)
+	return params
+
+def load_all_pages(series, request, params):
+	return list(get_pages(series.navbar, request=request, profile=False, **params))
+
+def run_series(series_list, params):
+	# With more than one series, the pages of all series are loaded at the
+	# same time in threads sharing one site session, while the series whose
+	# pages have arrived are checked (one after another) in this thread.
+	global Episode_DB
+	start_profile(params.pop('profile', None))
+	start_metrics(params.pop('metrics', None))
+	db = params.pop('db', None)
+	watch = params.pop('watch', None)
+	interval = params.pop('interval', Watch_Interval)
+	multiple = len(series_list) > 1
+	if watch and multiple:
+		err('Only one series can be watched')
+
+	request = site_request() if multiple and 'snapshot' not in params else None
+	runs = []
+	for series in series_list:
+		run_params = series_params(series, params, multiple)
+		load_params = {param: run_params.pop(param) for param in Load_Params if param in run_params}
+		runs.append((series, run_params, load_params))
+
+	if db:
+		Episode_DB = episode_db.EpisodeDB(db)
+	executor = concurrent.futures.ThreadPoolExecutor(len(runs)) if multiple else None
+	if executor:
+		loading = [executor.submit(load_all_pages, series, request, load_params)
+			for series, run_params, load_params in runs]
+	try:
+		for i, (series, run_params, load_params) in enumerate(runs):
+			open_output(run_params)
+			series.setup()
+			changes = open_watch(watch, series, request) if watch else None
+			if executor:
+				with profile_phase('load pages'):
+					pages = loading[i].result()
+			else:
+				pages = get_pages(series.navbar, request=request, **load_params)
+
+			info_list = process_pages(series, pages, **run_params)
+			check_sequence(series, info_list)
+			if changes:
+				watch_pages(changes, info_list, series, interval)
+			close_output()
+	finally:
+		if executor:
+			executor.shutdown(cancel_futures=True)
+		if Episode_DB is not None:
+			Episode_DB.close()
+			Episode_DB = None
+		stop_metrics()
+
+	write_profile()
@@ -0,0 +1,387 @@
+import bisect
+import json
+import os
+import sys
+import threading
+import time
+from pywikibot import textlib
+
+Batch_Size = 50
+
+class WikiPage(object):
+	def __init__(self, title, ns, revid=None, text='', categories=(), extlinks=()):
+		self.title = title
+		self.ns = ns
+		self.revid = revid
+		self.text = text
+		self.categories = list(categories)
+		self.extlinks = list(extlinks)
+
+	@property
+	def raw_extracted_templates(self):
+		return textlib.extract_templates_and_params(self.text, True, True)
+
+	def to_json(self):
+		return json.dumps({
+			'title': self.title,
+			'ns': self.ns,
+			'revid': self.revid,
+			'categories': self.categories,
+			'extlinks': self.extlinks,
+			'text': self.text,
+		}, ensure_ascii=False)
+
+	@classmethod
+	def from_json(self, line):
+		return self(**json.loads(line))
+
+def site_request(site):
+	def request(**params):
+		return site.simple_request(**params).submit()
+	return request
+
+def request_type(params):
+	return params.get('generator') or params.get('list') or params.get('prop') or params.get('action', '')
+
+def metered_request(request, metrics):
+	# pywikibot doesn't expose the raw response, so the number of bytes is
+	# the size of the decoded response encoded again as JSON, and it's
+	# reported as such (api_response_decoded_bytes_total).
+	def metered(**params):
+		start = time.perf_counter()
+		result = request(**params)
+		seconds = time.perf_counter() - start
+		metrics.add_request(request_type(params), seconds,
+			len(json.dumps(result, ensure_ascii=False).encode()))
+		return result
+	return metered
+
+Metrics_Interval = 10
+
+# Upper bounds (in seconds) of the request latency histogram buckets. The
+# last bucket (+Inf) counts the requests that took longer than 60 seconds.
+Latency_Buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def bucket_quantile(bucket_counts, q):
+	# The upper bound of the bucket that contains the q-quantile, or None if
+	# it's in the last (+Inf) bucket
+	rank = q * sum(bucket_counts)
+	count = 0
+	for le, bucket_count in zip(Latency_Buckets, bucket_counts):
+		count += bucket_count
+		if count >= rank:
+			return le
+	return None
+
+class Metrics(object):
+	# Progress of a long-running sweep: pages and revisions per second, API
+	# requests and bytes, cache hits, ETA and a request latency histogram.
+	# A thread writes them every interval seconds to stderr and (optionally)
+	# to a Prometheus textfile, so that a stalled sweep can be told apart
+	# from a throttled one by its idle time.
+
+	Quantiles = (0.5, 0.9, 0.99)
+
+	def __init__(self, job, filename=None, interval=Metrics_Interval, file=sys.stderr):
+		self.job = job
+		self.filename = filename
+		self.interval = interval
+		self.file = file
+		self.lock = threading.Lock()
+		self.start_time = time.monotonic()
+		self.last_progress = self.start_time
+		self.total = 0
+		self.num_pages = 0
+		self.num_revisions = 0
+		self.num_hits = 0
+		self.num_misses = 0
+		self.requests = {}
+		self.stopped = threading.Event()
+		self.thread = None
+
+	def start(self):
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		self.stopped.set()
+		if self.thread:
+			self.thread.join()
+		self.report()
+
+	def run(self):
+		while not self.stopped.wait(self.interval):
+			self.report()
+
+	def add_total(self, num_pages):
+		with self.lock:
+			self.total += num_pages
+
+	def add_pages(self, num_pages=1, num_revisions=0):
+		with self.lock:
+			self.num_pages += num_pages
+			self.num_revisions += num_revisions
+			self.last_progress = time.monotonic()
+
+	def add_cache(self, num_hits, num_misses):
+		with self.lock:
+			self.num_hits += num_hits
+			self.num_misses += num_misses
+
+	def add_request(self, kind, seconds, num_bytes):
+		with self.lock:
+			r = self.requests.get(kind)
+			if r is None:
+				r = self.requests[kind] = [0, 0.0, 0, [0] * (len(Latency_Buckets) + 1)]
+			r[0] += 1
+			r[1] += seconds
+			r[2] += num_bytes
+			r[3][bisect.bisect_left(Latency_Buckets, seconds)] += 1
+			self.last_progress = time.monotonic()
+
+	def values(self):
+		with self.lock:
+			now = time.monotonic()
+			elapsed = max(now - self.start_time, 1e-9)
+			values = {
+				'elapsed': elapsed,
+				'idle': now - self.last_progress,
+				'total': self.total,
+				'pages': self.num_pages,
+				'revisions': self.num_revisions,
+				'pages_per_sec': self.num_pages / elapsed,
+				'revisions_per_sec': self.num_revisions / elapsed,
+				'hits': self.num_hits,
+				'misses': self.num_misses,
+				'requests': {kind: (count, seconds, num_bytes, list(bucket_counts))
+					for kind, (count, seconds, num_bytes, bucket_counts) in sorted(self.requests.items())},
+			}
+		lookups = values['hits'] + values['misses']
+		values['hit_ratio'] = values['hits'] / lookups if lookups else None
+		remaining = values['total'] - values['pages']
+		values['eta'] = remaining / values['pages_per_sec'] if remaining > 0 and values['pages'] else None
+		return values
+
+	def report(self):
+		values = self.values()
+		self.write_line(values)
+		if self.filename:
+			self.write_textfile(values)
+
+	def write_line(self, v):
+		fields = [self.job]
+		fields.append('{:,}/{:,} pages'.format(v['pages'], v['total']) if v['total'] else
+			'{:,} pages'.format(v['pages']))
+		fields.append('{:,.1f} pages/s'.format(v['pages_per_sec']))
+		if v['revisions']:
+			fields.append('{:,.1f} revisions/s'.format(v['revisions_per_sec']))
+		num_requests = sum(r[0] for r in v['requests'].values())
+		num_bytes = sum(r[2] for r in v['requests'].values())
+		fields.append('{:,} requests'.format(num_requests))
+		fields.append('{:,.1f} MB'.format(num_bytes / 1e6))
+		if v['hit_ratio'] is not None:
+			fields.append('cache {:.1%}'.format(v['hit_ratio']))
+		if v['eta'] is not None:
+			fields.append('ETA {}'.format(time.strftime('%H:%M:%S', time.gmtime(v['eta']))))
+		fields.append('idle {:.0f}s'.format(v['idle']))
+		for kind, (count, seconds, num_bytes, bucket_counts) in v['requests'].items():
+			bounds = []
+			for q in self.Quantiles:
+				le = bucket_quantile(bucket_counts, q)
+				bounds.append('p{:g} {}{:g}s'.format(q * 100, '<=' if le else '>', le or Latency_Buckets[-1]))
+			fields.append('{} {}'.format(kind, ' '.join(bounds)))
+		print(*fields, sep=' | ', file=self.file, flush=True)
+
+	def write_textfile(self, v):
+		job = 'job="{}"'.format(self.job)
+		lines = []
+		def metric(name, metric_type, help_text, samples):
+			lines.append('# HELP wikibot_{} {}'.format(name, help_text))
+			lines.append('# TYPE wikibot_{} {}'.format(name, metric_type))
+			for suffix, labels, value in samples:
+				value = round(value, 6) if isinstance(value, float) else value
+				lines.append('wikibot_{}{}{{{}}} {}'.format(name, suffix, ','.join((job, *labels)), value))
+
+		metric('pages_total', 'counter', 'Pages processed.', [('', (), v['pages'])])
+		metric('pages_expected', 'gauge', 'Pages selected for processing.', [('', (), v['total'])])
+		metric('revisions_total', 'counter', 'Revisions processed.', [('', (), v['revisions'])])
+		metric('pages_per_second', 'gauge', 'Average pages per second.', [('', (), v['pages_per_sec'])])
+		metric('revisions_per_second', 'gauge', 'Average revisions per second.', [('', (), v['revisions_per_sec'])])
+		metric('cache_hits_total', 'counter', 'Pages that did not have to be fetched again.', [('', (), v['hits'])])
+		metric('cache_misses_total', 'counter', 'Pages that had to be fetched.', [('', (), v['misses'])])
+		if v['eta'] is not None:
+			metric('eta_seconds', 'gauge', 'Estimated seconds until all pages are processed.', [('', (), v['eta'])])
+		metric('elapsed_seconds', 'gauge', 'Seconds since the sweep started.', [('', (), v['elapsed'])])
+		metric('idle_seconds', 'gauge', 'Seconds since the last page or API response.', [('', (), v['idle'])])
+
+		requests = v['requests'].items()
+		metric('api_response_decoded_bytes_total', 'counter', 'Size of the decoded API responses encoded as JSON.',
+			[('', ('type="{}"'.format(kind),), r[2]) for kind, r in requests])
+		samples = []
+		for kind, (count, seconds, num_bytes, bucket_counts) in requests:
+			label = 'type="{}"'.format(kind)
+			cumulative = 0
+			for le, bucket_count in zip((*Latency_Buckets, '+Inf'), bucket_counts):
+				cumulative += bucket_count
+				samples.append(('_bucket', (label, 'le="{}"'.format(le)), cumulative))
+			samples.append(('_sum', (label,), seconds))
+			samples.append(('_count', (label,), count))
+		metric('api_request_seconds', 'histogram', 'API request latency.', samples)
+
+		temp_filename = self.filename + '.tmp'
+		with open(temp_filename, 'w') as f:
+			print(*lines, sep='\n', file=f)
+		os.replace(temp_filename, self.filename)
+
+def query(request, **params):
+	params['action'] = 'query'
+	params['formatversion'] = 2
+	continue_params = {}
+	while True:
+		result = request(**params, **continue_params)
+		yield result.get('query', {})
+		continue_params = result.get('continue')
+		if not continue_params:
+			break
+
+def references(request, template, namespace=0):
+	for result in query(request,
+		generator='embeddedin',
+		geititle=template,
+		geinamespace=namespace,
+		geilimit='max',
+		prop='info',
+	):
+		for page in result.get('pages', ()):
+			yield page['title'], page.get('lastrevid')
+
+def transcluding(request, titles, template, batch_size=Batch_Size):
+	# The given titles whose pages transclude the template
+	for i in range(0, len(titles), batch_size):
+		for result in query(request,
+			titles='|'.join(titles[i:i+batch_size]),
+			prop='templates',
+			tltemplates=template,
+			tllimit='max',
+		):
+			for page in result.get('pages', ()):
+				if page.get('templates'):
+					yield page['title']
+
+def recent_changes(request, start, namespace=0):
+	for result in query(request,
+		list='recentchanges',
+		rcstart=start,
+		rcdir='newer',
+		rcnamespace=namespace,
+		rctype='edit|new',
+		rcprop='title|ids|timestamp',
+		rclimit='max',
+	):
+		for change in result.get('recentchanges', ()):
+			yield change['title'], change['revid'], change['timestamp'], change['type']
+
+def merge_page(page, data):
+	if page is None:
+		revisions = data.get('revisions')
+		return WikiPage(data['title'], data['ns'],
+			revid=revisions[0]['revid'] if revisions else None,
+			text=revisions[0]['slots']['main']['content'] if revisions else '',
+			categories=[c['title'] for c in data.get('categories', ())],
+			extlinks=[e['url'] for e in data.get('extlinks', ())])
+
+	# A continued response may carry the content that was cut off
+	# before as well as further categories and external links.
+	revisions = data.get('revisions')
+	if revisions and page.revid is None:
+		page.revid = revisions[0]['revid']
+		page.text = revisions[0]['slots']['main']['content']
+	page.categories.extend([c['title'] for c in data.get('categories', ())])
+	page.extlinks.extend([e['url'] for e in data.get('extlinks', ())])
+	return page
+
+def load_batch(request, titles):
+	pages = {}
+	for result in query(request,
+		titles='|'.join(titles),
+		prop='revisions|categories|extlinks',
+		rvprop='ids|content',
+		rvslots='main',
+		cllimit='max',
+		ellimit='max',
+	):
+		for data in result.get('pages', ()):
+			if data.get('missing') or data.get('invalid'):
+				continue
+			title = data['title']
+			pages[title] = merge_page(pages.get(title), data)
+
+	return [pages[title] for title in titles if title in pages]
+
+def load_pages(request, titles, batch_size=Batch_Size):
+	batch = []
+	for title in titles:
+		batch.append(title)
+		if len(batch) == batch_size:
+			yield from load_batch(request, batch)
+			batch = []
+	if batch:
+		yield from load_batch(request, batch)
+
+class PageCache(object):
+	def __init__(self, filename):
+		self.filename = filename
+		self.pages = {}
+		self.num_hits = 0
+		self.num_misses = 0
+
+		if os.path.exists(filename):
+			with open(filename) as f:
+				for title, (ns, revid, text, categories, extlinks) in json.load(f).items():
+					self.pages[title] = WikiPage(title, ns, revid, text, categories, extlinks)
+
+	def save(self):
+		data = {page.title: (page.ns, page.revid, page.text, page.categories, page.extlinks)
+			for page in self.pages.values()}
+		temp_filename = self.filename + '.tmp'
+		with open(temp_filename, 'w') as f:
+			json.dump(data, f, ensure_ascii=False)
+		os.replace(temp_filename, self.filename)
+
+	def load_pages(self, request, references, metrics=None):
+		# Only pages whose latest revision differs from the cached one are
+		# downloaded again. Pages that are no longer referenced are dropped.
+		titles = []
+		changed = []
+		for title, revid in references:
+			titles.append(title)
+			page = self.pages.get(title)
+			if page is None or page.revid != revid:
+				changed.append(title)
+
+		self.num_misses = len(changed)
+		self.num_hits = len(titles) - len(changed)
+		if metrics:
+			metrics.add_cache(self.num_hits, self.num_misses)
+
+		pages = {page.title: page for page in load_pages(request, changed)}
+		changed = set(changed)
+		for title in titles:
+			page = pages.get(title) if title in changed else self.pages.get(title)
+			if page:
+				pages[title] = page
+				yield page
+
+		self.pages = pages
+		self.save()
+
+def read_snapshot(filename):
+	with open(filename) as f:
+		for line in f:
+			yield WikiPage.from_json(line)
+
+def record_snapshot(pages, filename):
+	with open(filename, 'w') as f:
+		for page in pages:
+			print(page.to_json(), file=f)
+			yield page